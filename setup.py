@@ -18,6 +18,10 @@ setup(
         'django-nose==1.4.4',
         'tox',
     ],
+    extras_require={
+        'cryptography': ['cryptography'],
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Environment :: Plugins',
@@ -28,7 +32,11 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     package_dir={'': 'src'},
-    packages=['django_fields'],
+    packages=[
+        'django_fields',
+        'django_fields.management',
+        'django_fields.management.commands',
+    ],
     include_package_data=True,
     test_suite="runtests.runtests",
 )
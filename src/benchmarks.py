@@ -0,0 +1,231 @@
+"""Throughput benchmarks for the fields of django_fields.
+
+Runs against an in-memory sqlite database and needs no other services:
+
+    python benchmarks.py [--quick] [--output results.json] [--compare old.json]
+
+Every result reports values per second and microseconds per value.  With
+``--output`` results are also written as JSON, and ``--compare`` prints
+the change against a previous JSON result, to spot regressions between
+releases.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import warnings
+
+import django
+from django.conf import settings
+
+BLOCK_TYPES = (None, 'MODE_CBC')
+TEXT_SIZES = (10, 1000, 100 * 1000, 1000 * 1000)
+CHAR_SIZES = (10, 100, 1000)
+BULK_ROWS = 1000
+
+
+def setup():
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmarks-secret-key-benchmarks-secret-key',
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            },
+        },
+        INSTALLED_APPS=['django_fields'],
+    )
+    django.setup()
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+
+def measure(func, values, min_time):
+    """Calls ``func`` on every value (repeatedly, until ``min_time``
+    seconds have passed) and returns (calls, elapsed seconds)."""
+    calls = 0
+    elapsed = 0.0
+    while elapsed < min_time:
+        start = time.time()
+        for value in values:
+            func(value)
+        elapsed += time.time() - start
+        calls += len(values)
+    return calls, elapsed
+
+
+def result(name, field, block_type, size, operation, calls, elapsed):
+    return {
+        'benchmark': name,
+        'field': field,
+        'block_type': block_type or 'ECB',
+        'size': size,
+        'operation': operation,
+        'iterations': calls,
+        'ops_per_sec': calls / elapsed,
+        'us_per_op': elapsed / calls * 1e6,
+    }
+
+
+def field_cases():
+    """Yields (field name, field factory, size, sample values)."""
+    from django_fields import fields
+
+    def text(size):
+        return [(u'%d' % index + u'x' * size)[:size] for index in range(10)]
+
+    for size in CHAR_SIZES:
+        yield ('EncryptedCharField', fields.EncryptedCharField,
+               {'max_length': size}, size, text(size))
+    for size in TEXT_SIZES:
+        yield ('EncryptedTextField', fields.EncryptedTextField,
+               {}, size, text(size))
+    yield ('EncryptedEmailField', fields.EncryptedEmailField,
+           {'max_length': 255}, 20,
+           [u'user%d@example.com' % index for index in range(10)])
+    today = datetime.date.today()
+    yield ('EncryptedDateField', fields.EncryptedDateField, {}, 10,
+           [today - datetime.timedelta(days=index) for index in range(10)])
+    now = datetime.datetime.now()
+    yield ('EncryptedDateTimeField', fields.EncryptedDateTimeField, {}, 26,
+           [now - datetime.timedelta(seconds=index) for index in range(10)])
+    yield ('EncryptedIntField', fields.EncryptedIntField, {}, 8,
+           [index * 1234567 for index in range(10)])
+    yield ('EncryptedLongField', fields.EncryptedLongField, {}, 16,
+           [index * 10 ** 30 for index in range(10)])
+    yield ('EncryptedFloatField', fields.EncryptedFloatField, {}, 8,
+           [index / 3.0 for index in range(10)])
+
+
+def bench_fields(min_time):
+    from django_fields.fields import PickleField
+
+    results = []
+    for name, field_class, kwargs, size, values in field_cases():
+        for block_type in BLOCK_TYPES:
+            field = field_class(block_type=block_type, **kwargs)
+            encrypted = [field.get_db_prep_value(value) for value in values]
+            calls, elapsed = measure(field.get_db_prep_value, values, min_time)
+            results.append(result(
+                'field', name, block_type, size, 'get_db_prep_value',
+                calls, elapsed))
+            calls, elapsed = measure(
+                lambda value: field.from_db_value(value, None, None, None),
+                encrypted, min_time)
+            results.append(result(
+                'field', name, block_type, size, 'from_db_value',
+                calls, elapsed))
+
+    field = PickleField()
+    for size in TEXT_SIZES:
+        values = [{'index': index, 'data': 'x' * size} for index in range(10)]
+        pickled = [field.get_db_prep_value(value) for value in values]
+        calls, elapsed = measure(field.get_db_prep_value, values, min_time)
+        results.append(result(
+            'field', 'PickleField', 'n/a', size, 'get_db_prep_value',
+            calls, elapsed))
+        calls, elapsed = measure(
+            lambda value: field.from_db_value(value, None, None, None),
+            pickled, min_time)
+        results.append(result(
+            'field', 'PickleField', 'n/a', size, 'from_db_value',
+            calls, elapsed))
+    return results
+
+
+def bench_saving(rows):
+    from django.db import connection, models
+    from django_fields.fields import EncryptedCharField, EncryptedTextField
+    from django_fields.models import EncryptedManager
+
+    results = []
+    for block_type in BLOCK_TYPES:
+        class Meta:
+            app_label = 'django_fields'
+            db_table = 'benchmark_%s' % (block_type or 'ecb').lower()
+
+        model = type('Benchmark%s' % (block_type or 'ECB'), (models.Model,), {
+            '__module__': __name__,
+            'Meta': Meta,
+            'email': EncryptedCharField(max_length=64, block_type=block_type),
+            'notes': EncryptedTextField(block_type=block_type),
+            'objects': models.Manager(),
+            'encrypted_objects': EncryptedManager(),
+        })
+        with connection.schema_editor() as editor:
+            editor.create_model(model)
+
+        def objects():
+            return [model(email=u'user%d@example.com' % index, notes=u'x' * 200)
+                    for index in range(rows)]
+
+        for operation, save in (
+                ('save', lambda objs: [obj.save() for obj in objs]),
+                ('bulk_create', model.objects.bulk_create),
+                ('encrypted bulk_create', model.encrypted_objects.bulk_create)):
+            objs = objects()
+            start = time.time()
+            save(objs)
+            elapsed = time.time() - start
+            results.append(result(
+                'save', model.__name__, block_type, rows, operation,
+                rows, elapsed))
+            model.objects.all().delete()
+    return results
+
+
+def compare(results, previous):
+    def key(item):
+        return (item['benchmark'], item['field'], item['block_type'],
+                item['size'], item['operation'])
+
+    previous = dict((key(item), item) for item in previous['results'])
+    for item in results:
+        old = previous.get(key(item))
+        if old is not None:
+            item['change'] = item['ops_per_sec'] / old['ops_per_sec'] - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='shorter runs, for smoke-testing')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    setup()
+    from django_fields.backends import backend
+
+    results = bench_fields(0.05 if args.quick else 0.5)
+    results.extend(bench_saving(100 if args.quick else BULK_ROWS))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    for item in results:
+        line = '%-8s %-24s %-9s %8d  %-24s %12.1f values/s %12.2f us/value' % (
+            item['benchmark'], item['field'], item['block_type'], item['size'],
+            item['operation'], item['ops_per_sec'], item['us_per_op'])
+        if 'change' in item:
+            line += '  %+.1f%%' % (item['change'] * 100)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'backend': backend.name,
+                'platform': platform.platform(),
+                'date': datetime.datetime.utcnow().isoformat(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
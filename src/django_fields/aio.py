@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""asyncio helpers for encrypted fields (Python 3.6+).
+
+Decrypting large values blocks the event loop, so these helpers decrypt
+values (or chunks of rows) larger than ``threshold`` bytes in a thread
+pool and smaller ones directly in the loop, where a thread hop would
+cost more than the decryption itself.
+
+Usage::
+
+    from django_fields.aio import astream_values
+
+    async for row in astream_values(Document.objects.filter(...), 'id', 'body'):
+        ...
+
+"""
+import asyncio
+from concurrent import futures
+
+import django
+from django.db import connections
+
+from .models import build_rows, decrypt_columns
+
+DEFAULT_THRESHOLD = 16 * 1024
+
+
+def _size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+
+async def _call(func, size, threshold, executor, *args):
+    if size > threshold:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, func, *args)
+    return func(*args)
+
+
+async def adecrypt(field, value, threshold=DEFAULT_THRESHOLD, executor=None):
+    """Async counterpart of ``field.from_db_value(value, ...)``."""
+    return await _call(
+        field.from_db_value, _size(value), threshold, executor,
+        value, None, None, None)
+
+
+async def adecrypt_many(field, values, threshold=DEFAULT_THRESHOLD, executor=None):
+    """Async counterpart of ``field.from_db_values(values)``; ``threshold``
+    applies to the total size of ``values``."""
+    values = list(values)
+    return await _call(
+        field.from_db_values, sum(_size(value) for value in values),
+        threshold, executor, values)
+
+
+async def aencrypt_many(field, values, threshold=DEFAULT_THRESHOLD, executor=None):
+    """Async counterpart of ``field.encrypt_many(values)``."""
+    values = list(values)
+    return await _call(
+        field.encrypt_many, sum(_size(value) for value in values),
+        threshold, executor, values)
+
+
+async def _arows(queryset, chunk_size):
+    """Yields chunks of rows of ``queryset``.  Uses ``aiterator()`` where
+    available (Django 4.1+), otherwise runs the queryset in one dedicated
+    thread, as database connections can't move between threads."""
+    if hasattr(queryset, 'aiterator'):
+        chunk = []
+        async for row in queryset.aiterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    if django.VERSION >= (2, 0):
+        rows = queryset.iterator(chunk_size=chunk_size)
+    else:
+        rows = queryset.iterator()
+    loop = asyncio.get_event_loop()
+    fetcher = futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        def fetch():
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    break
+            return chunk
+
+        while True:
+            chunk = await loop.run_in_executor(fetcher, fetch)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await loop.run_in_executor(fetcher, _close_connections)
+        fetcher.shutdown(wait=False)
+
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+async def astream_values(queryset, *fields, chunk_size=2000, as_dict=True,
+                         threshold=DEFAULT_THRESHOLD, executor=None):
+    """Async counterpart of ``EncryptedQuerySet.stream_values()`` (or
+    ``stream_values_list()`` with ``as_dict=False``).  Chunks whose
+    encrypted columns are larger than ``threshold`` bytes in total are
+    decrypted in ``executor`` (by default the loop's thread pool)."""
+    fields, raw_queryset, select_names, encrypted_fields = queryset._raw_values(fields)
+    connection = connections[queryset.db]
+    async for chunk in _arows(raw_queryset, chunk_size):
+        size = sum(
+            _size(row[alias])
+            for row in chunk for name, alias, field in encrypted_fields)
+        columns = await _call(
+            decrypt_columns, size, threshold, executor,
+            chunk, encrypted_fields, connection)
+        for row in build_rows(chunk, columns, fields, select_names,
+                              encrypted_fields, as_dict):
+            yield row
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""NumPy arrays of the values of encrypted number fields.
+
+Requires numpy.  Columns of an ``EncryptedIntField`` or
+``EncryptedFloatField`` with ``compact=True`` are converted from and to
+arrays without a Python int or float per value: values are decrypted in
+one batch (see ``BaseEncryptedField.decrypt_many``) and their packed
+plaintexts read with a single ``numpy.frombuffer`` call, and the other
+way around::
+
+    from django_fields.arrays import decrypt_array, encrypt_array
+
+    field = Payment._meta.get_field('amount')
+    amounts = decrypt_array(field, raw_amounts)
+    encrypted = encrypt_array(field, amounts * 1.1)
+
+or ``Payment.objects.values_array('amount')`` (see ``EncryptedQuerySet``).
+
+``encrypt_array`` returns the stored values, which can be assigned to
+model instances for ``EncryptedQuerySet.bulk_create`` (already encrypted
+values are saved unchanged).
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .fields import EncryptedFloatField, EncryptedIntField
+
+# Big-endian (stored) and native dtypes of the packed values.
+_DTYPES = (
+    (EncryptedFloatField, '>f8', 'float64'),
+    (EncryptedIntField, '>i8', 'int64'),
+)
+
+
+def _dtypes(field):
+    if numpy is None:
+        raise ImportError("django_fields.arrays requires numpy")
+    for field_class, packed, native in _DTYPES:
+        if isinstance(field, field_class):
+            return numpy.dtype([('tag', 'S1'), ('value', packed)]), native
+    raise ValueError(
+        "%s has no array codec" % field.__class__.__name__)
+
+
+def decrypt_array(field, values):
+    """Decrypts the stored ``values`` of a number field into an array.
+
+    Values in other encodings than the packed one are converted one by
+    one.  ``None`` becomes NaN in float arrays; int arrays can't hold
+    it."""
+    packed_dtype, native = _dtypes(field)
+    plaintexts = field.decrypt_many(values)
+    packed = [index for index, plaintext in enumerate(plaintexts)
+              if field._is_packed(plaintext)]
+    records = numpy.frombuffer(
+        b''.join(plaintexts[index] for index in packed), dtype=packed_dtype)
+    if len(packed) == len(plaintexts):
+        return records['value'].astype(native)
+
+    array = numpy.empty(len(plaintexts), dtype=native)
+    array[packed] = records['value']
+    for index, plaintext in enumerate(plaintexts):
+        if field._is_packed(plaintext):
+            continue
+        if plaintext is None:
+            if native != 'float64':
+                raise ValueError("NULL values can't be stored in int arrays")
+            array[index] = numpy.nan
+        else:
+            array[index] = field._from_plaintext(plaintext)
+    return array
+
+
+def encrypt_array(field, array, connection=None):
+    """Encrypts the values of ``array`` with a number field with
+    ``compact=True``; returns a list of the stored values."""
+    packed_dtype, native = _dtypes(field)
+    if not field.compact:
+        raise ValueError("encrypt_array requires a field with compact=True")
+    records = numpy.empty(len(array), dtype=packed_dtype)
+    records['tag'] = field.packed_tag
+    records['value'] = array
+    buffer = records.tobytes()
+    size = packed_dtype.itemsize
+    return field._encrypt_plaintexts(
+        [buffer[offset:offset + size]
+         for offset in range(0, len(buffer), size)],
+        connection)
@@ -0,0 +1,311 @@
+"""Crypto backends of django_fields.
+
+The backend is chosen once, when django_fields is imported, with the
+``DJANGO_FIELDS_CRYPTO_BACKEND`` setting:
+
+* ``'cryptography'``: the cryptography package (OpenSSL), which uses
+  AES-NI where the CPU has it and releases the GIL while encrypting;
+* ``'pycrypto'``: pycrypto or pycryptodome, through the ``Crypto`` package.
+
+By default cryptography is used if it is installed.  It only provides
+AES; other ciphers always come from pycrypto.
+
+Backends hand out cipher modules with pycrypto's interface (a
+``block_size``, ``MODE_*`` constants and ``new(key, mode, iv)``), which
+produce identical ciphertexts, so the backend can be changed at any time.
+
+The authenticated encryption (AEAD) modes of ``AEAD_MODES`` need
+cryptography or pycryptodome (pycrypto has none).  Their modules have a
+``nonce_size``, a ``tag_size`` and ``new(key)``, which returns an object
+with ``encrypt(nonce, data)``, giving the ciphertext followed by the tag,
+and ``decrypt(nonce, data)``, which raises ``ValueError`` if the tag does
+not match.
+"""
+import os
+
+from django.conf import settings
+
+BACKENDS = ('cryptography', 'pycrypto')
+
+# Maps the block types of AEAD modes to their cipher.
+AEAD_MODES = {
+    'MODE_GCM': 'AES',
+    'MODE_CHACHA20_POLY1305': 'ChaCha20',
+}
+
+
+def _check_aead_mode(cipher_type, block_type):
+    if AEAD_MODES.get(block_type) != cipher_type:
+        raise ValueError(
+            "Block type %s requires cipher %s" % (
+                block_type, AEAD_MODES.get(block_type)))
+
+
+class PycryptodomeAEAD(object):
+    '''AEAD mode module on top of pycryptodome; ``new_cipher(key, nonce)``
+    returns a pycryptodome cipher object.'''
+
+    nonce_size = 12
+    tag_size = 16
+    releases_gil = False
+
+    def __init__(self, new_cipher, key_size):
+        self._new_cipher = new_cipher
+        self.key_size = key_size
+
+    def new(self, key):
+        return PycryptodomeAEADKey(self._new_cipher, key, self.tag_size)
+
+
+class PycryptodomeAEADKey(object):
+    def __init__(self, new_cipher, key, tag_size):
+        self._new_cipher = new_cipher
+        self._key = key
+        self._tag_size = tag_size
+
+    def encrypt(self, nonce, data):
+        ciphertext, tag = self._new_cipher(
+            self._key, nonce).encrypt_and_digest(data)
+        return ciphertext + tag
+
+    def decrypt(self, nonce, data):
+        try:
+            return self._new_cipher(self._key, nonce).decrypt_and_verify(
+                data[:-self._tag_size], data[-self._tag_size:])
+        except ValueError:
+            raise ValueError("Value failed authentication")
+
+
+class PycryptoBackend(object):
+    name = 'pycrypto'
+    # pycrypto holds the GIL while encrypting, so only processes (and not
+    # threads) encrypt in parallel; see django_fields.parallel.
+    releases_gil = False
+
+    def __init__(self):
+        from Crypto import Random
+        self._random = Random
+
+    def get_cipher(self, cipher_type):
+        try:
+            imp = __import__('Crypto.Cipher', globals(), locals(), [cipher_type], -1)
+        except:
+            imp = __import__('Crypto.Cipher', globals(), locals(), [cipher_type])
+        return getattr(imp, cipher_type)
+
+    def get_aead(self, cipher_type, block_type):
+        _check_aead_mode(cipher_type, block_type)
+        if block_type == 'MODE_GCM':
+            cipher = self.get_cipher(cipher_type)
+            if not hasattr(cipher, 'MODE_GCM'):
+                raise ValueError(
+                    "MODE_GCM requires pycryptodome or cryptography")
+            return PycryptodomeAEAD(
+                lambda key, nonce: cipher.new(key, cipher.MODE_GCM, nonce=nonce),
+                cipher.key_size)
+        try:
+            from Crypto.Cipher import ChaCha20_Poly1305
+        except ImportError:
+            raise ValueError(
+                "MODE_CHACHA20_POLY1305 requires pycryptodome or cryptography")
+        return PycryptodomeAEAD(
+            lambda key, nonce: ChaCha20_Poly1305.new(key=key, nonce=nonce),
+            ChaCha20_Poly1305.key_size)
+
+    def random_reader(self):
+        '''Returns a ``read(size)`` function for random bytes.  Readers
+        must not be shared between processes.'''
+        return self._random.new().read
+
+
+class CryptographyCipher(object):
+    '''The interface of a pycrypto cipher module on top of a
+    ``cryptography`` algorithm.'''
+
+    # OpenSSL releases the GIL, so threads encrypt in parallel.
+    releases_gil = True
+
+    # The values of pycrypto's constants.
+    MODE_ECB = 1
+    MODE_CBC = 2
+    MODE_CFB = 3
+    MODE_OFB = 5
+
+    # Names of the cryptography modes; pycrypto's CFB mode has 8 bit
+    # segments by default.
+    MODE_NAMES = {
+        MODE_ECB: 'ECB',
+        MODE_CBC: 'CBC',
+        MODE_CFB: 'CFB8',
+        MODE_OFB: 'OFB',
+    }
+
+    def __init__(self, algorithm, mode_modules, backend):
+        self.algorithm = algorithm
+        self.block_size = algorithm.block_size // 8
+        self.key_size = tuple(
+            sorted(size // 8 for size in algorithm.key_sizes if size <= 256))
+        self._backend = backend
+        # Modes are looked up on first use, in the first of
+        # ``mode_modules`` which has them: newer cryptography releases
+        # moved CFB8 and OFB to its "decrepit" package (and deprecated
+        # them in the old place).
+        self._mode_modules = mode_modules
+        self._modes = {}
+
+    def _mode(self, mode):
+        mode_class = self._modes.get(mode)
+        if mode_class is None:
+            name = self.MODE_NAMES.get(mode)
+            for module in self._mode_modules:
+                mode_class = getattr(module, name, None) if name else None
+                if mode_class is not None:
+                    break
+            else:
+                raise ValueError(
+                    "Block mode %s is not supported by the cryptography "
+                    "backend" % (name or mode))
+            self._modes[mode] = mode_class
+        return mode_class
+
+    def new(self, key, mode=MODE_ECB, iv=None):
+        from cryptography.hazmat.primitives.ciphers import Cipher
+        # Block modes only take whole blocks, as in pycrypto.
+        if mode in (self.MODE_ECB, self.MODE_CBC):
+            block_size = self.block_size
+        else:
+            block_size = 1
+        if mode == self.MODE_ECB:
+            mode = self._mode(mode)()
+        else:
+            mode = self._mode(mode)(iv)
+        return CryptographyCipherContext(
+            Cipher(self.algorithm(key), mode, backend=self._backend),
+            block_size)
+
+
+class CryptographyCipherContext(object):
+    '''A pycrypto-like cipher object.  Like pycrypto's, it chains
+    consecutive ``encrypt`` (or ``decrypt``) calls in chaining modes.
+
+    Data which is not a multiple of ``block_size`` in length is rejected
+    with ``ValueError``: the context would keep its last partial block
+    and prepend it to the data of the next call.'''
+
+    def __init__(self, cipher, block_size=1):
+        self._cipher = cipher
+        self._block_size = block_size
+        self._encryptor = None
+        self._decryptor = None
+
+    def _check_length(self, data):
+        if len(data) % self._block_size:
+            raise ValueError(
+                "Input strings must be a multiple of %d in length" %
+                self._block_size)
+
+    def encrypt(self, data):
+        self._check_length(data)
+        if self._encryptor is None:
+            self._encryptor = self._cipher.encryptor()
+        return self._encryptor.update(data)
+
+    def decrypt(self, data):
+        self._check_length(data)
+        if self._decryptor is None:
+            self._decryptor = self._cipher.decryptor()
+        return self._decryptor.update(data)
+
+
+class CryptographyAEAD(object):
+    '''AEAD mode module on top of a ``cryptography`` AEAD class.'''
+
+    nonce_size = 12
+    tag_size = 16
+    releases_gil = True
+
+    def __init__(self, aead_class, key_size):
+        self._aead_class = aead_class
+        self.key_size = key_size
+
+    def new(self, key):
+        return CryptographyAEADKey(self._aead_class(key))
+
+
+class CryptographyAEADKey(object):
+    def __init__(self, aead):
+        self._aead = aead
+
+    def encrypt(self, nonce, data):
+        return self._aead.encrypt(nonce, data, None)
+
+    def decrypt(self, nonce, data):
+        from cryptography.exceptions import InvalidTag
+        try:
+            return self._aead.decrypt(nonce, data, None)
+        except InvalidTag:
+            raise ValueError("Value failed authentication")
+
+
+class CryptographyBackend(object):
+    name = 'cryptography'
+    releases_gil = True
+
+    def __init__(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import algorithms, modes
+        from cryptography.hazmat.primitives.ciphers.aead import (
+            AESGCM, ChaCha20Poly1305)
+        try:
+            from cryptography.hazmat.decrepit.ciphers import (
+                modes as decrepit_modes)
+            mode_modules = (decrepit_modes, modes)
+        except ImportError:
+            mode_modules = (modes,)
+        self._ciphers = {
+            'AES': CryptographyCipher(
+                algorithms.AES, mode_modules, default_backend()),
+        }
+        self._aeads = {
+            'MODE_GCM': CryptographyAEAD(AESGCM, (16, 24, 32)),
+            'MODE_CHACHA20_POLY1305': CryptographyAEAD(ChaCha20Poly1305, 32),
+        }
+        self._fallback = None
+
+    def _get_fallback(self):
+        if self._fallback is None:
+            self._fallback = PycryptoBackend()
+        return self._fallback
+
+    def get_cipher(self, cipher_type):
+        cipher = self._ciphers.get(cipher_type)
+        if cipher is None:
+            cipher = self._get_fallback().get_cipher(cipher_type)
+        return cipher
+
+    def get_aead(self, cipher_type, block_type):
+        _check_aead_mode(cipher_type, block_type)
+        return self._aeads[block_type]
+
+    def random_reader(self):
+        return os.urandom
+
+
+def load_backend(name=None):
+    '''Returns the backend called ``name``, or by default the first one
+    of ``BACKENDS`` which can be imported.'''
+    if name is None:
+        try:
+            return CryptographyBackend()
+        except ImportError:
+            return PycryptoBackend()
+    if name == 'cryptography':
+        return CryptographyBackend()
+    if name == 'pycrypto':
+        return PycryptoBackend()
+    raise ValueError(
+        "Unknown crypto backend %r, use one of: %s" % (
+            name, ', '.join(BACKENDS)))
+
+
+backend = load_backend(getattr(settings, 'DJANGO_FIELDS_CRYPTO_BACKEND', None))
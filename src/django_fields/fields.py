@@ -1,17 +1,33 @@
+import base64
 import binascii
 import codecs
 import datetime
+import decimal
+import hashlib
+import hmac
+import os
+import re
 import string
+import struct
 import sys
+import threading
+import time
 import warnings
+from collections import OrderedDict
 
 from django import forms
 from django.forms import fields
 from django.db import models
+from django.db.models import lookups
+from django.db.models.fields import NOT_PROVIDED
+from django.db.models.expressions import Col
 from django.conf import settings
+from django.utils.timezone import get_fixed_timezone
 from django.utils.translation import ugettext_lazy as _
-from Crypto import Random
-from Crypto.Random import random
+
+from . import metrics
+from .backends import AEAD_MODES, backend
+from .keys import MAX_KEY_ID, registry as key_registry
 
 if hasattr(settings, 'USE_CPICKLE'):
     warnings.warn(
@@ -30,10 +46,318 @@ else:
 
 if sys.version_info[0] == 3:
     PYTHON3 = True
-    from django.utils.encoding import smart_str, force_text as force_unicode
+    string_types = str
+    from django.utils.encoding import (
+        smart_bytes, smart_str, force_text as force_unicode)
 else:
     PYTHON3 = False
-    from django.utils.encoding import smart_str, force_unicode
+    string_types = basestring
+    from django.utils.encoding import smart_bytes, smart_str, force_unicode
+
+
+class CipherFactory(object):
+    '''Creates cipher objects for one (cipher, block type, key) triple.
+
+    Factories are immutable and shared between all fields using the same
+    settings (see ``get_cipher_factory``).  Cipher objects for chaining
+    modes carry state, so ``new`` builds a fresh one for every value;
+    ECB cipher objects are stateless and cached once per thread.
+
+    ``cipher_object`` is a cipher module of a crypto backend (see
+    django_fields.backends).  ``releases_gil`` tells whether it encrypts
+    in parallel in threads; see django_fields.parallel.
+
+    For the AEAD modes of ``AEAD_MODES`` ``aead`` is the (stateless)
+    keyed AEAD object, and ``new``/``ecb`` are not available.'''
+
+    def __init__(self, cipher_object, block_type, secret_key):
+        self.cipher_object = cipher_object
+        self.block_type = block_type
+        self.secret_key = secret_key
+        self.releases_gil = getattr(cipher_object, 'releases_gil', False)
+        self._key = smart_bytes(secret_key)
+        self.aead = None
+        if block_type in AEAD_MODES:
+            # No padding is needed, so values can end at any byte.
+            self.block_size = 1
+            self.mode = None
+            self.nonce_size = cipher_object.nonce_size
+            self.tag_size = cipher_object.tag_size
+            self.aead = cipher_object.new(self._key)
+        elif block_type:
+            self.block_size = cipher_object.block_size
+            self.mode = getattr(cipher_object, block_type)
+        else:
+            self.block_size = cipher_object.block_size
+            self.mode = None
+        self._local = threading.local()
+
+    def ecb(self):
+        cipher = getattr(self._local, 'ecb', None)
+        if cipher is None:
+            cipher = self._local.ecb = self.cipher_object.new(
+                self._key, self.cipher_object.MODE_ECB)
+        return cipher
+
+    def new(self, iv=None):
+        if self.mode is None:
+            return self.ecb()
+        return self.cipher_object.new(self._key, self.mode, iv)
+
+
+class RandomPool(object):
+    '''Buffered source of cryptographically secure random bytes.
+
+    Reading a few bytes from the OS for every encrypted value costs a
+    syscall per row, so bytes are pre-fetched ``buffer_size`` at a time
+    and handed out from the buffer.  Buffers are kept per thread, and
+    are dropped after ``fork()`` so that child processes never reuse
+    bytes already handed out by their parent.'''
+
+    def __init__(self, buffer_size=4096):
+        self.buffer_size = buffer_size
+        self._local = threading.local()
+
+    def read(self, size):
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            local.pid = pid
+            local.read = backend.random_reader()
+            local.buffer = b''
+            local.offset = 0
+        if local.offset + size > len(local.buffer):
+            local.buffer = local.read(max(size, self.buffer_size))
+            local.offset = 0
+        offset = local.offset
+        local.offset = offset + size
+        return local.buffer[offset:offset + size]
+
+
+random_pool = RandomPool()
+
+# Maps random bytes onto string.printable; bytes which would make the
+# mapping biased (>= 200, as len(string.printable) == 100) are deleted.
+_PRINTABLE_TABLE = bytes(bytearray(
+    ord(string.printable[index % len(string.printable)])
+    for index in range(256)
+))
+_PRINTABLE_DELETE = bytes(bytearray(
+    range(len(string.printable) * 2, 256)))
+
+
+if PYTHON3 is True:
+    def _xor(a, b):
+        return (
+            int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+        ).to_bytes(len(a), 'big')
+
+
+def random_printable(size):
+    '''Returns ``size`` random bytes from ``string.printable``.'''
+    result = b''
+    while len(result) < size:
+        # About 78% of the bytes survive the translation.
+        chunk = random_pool.read((size - len(result)) * 4 // 3 + 8)
+        result += chunk.translate(_PRINTABLE_TABLE, _PRINTABLE_DELETE)
+    return result[:size]
+
+
+_cipher_factories = {}
+
+
+def get_cipher_factory(cipher_type, block_type, secret_key):
+    '''Returns a shared ``CipherFactory`` for the given settings.'''
+    cache_key = (cipher_type, block_type, secret_key)
+    factory = _cipher_factories.get(cache_key)
+    if factory is None:
+        if block_type in AEAD_MODES:
+            cipher_object = backend.get_aead(cipher_type, block_type)
+        else:
+            cipher_object = backend.get_cipher(cipher_type)
+        factory = _cipher_factories.setdefault(
+            cache_key,
+            CipherFactory(cipher_object, block_type, secret_key),
+        )
+    return factory
+
+
+class DecryptionCache(object):
+    '''Bounded LRU cache mapping stored (encrypted) values to their
+    decrypted text, with optional expiry of entries after ``ttl`` seconds.
+
+    A single cache per process is configured with the
+    ``DJANGO_FIELDS_DECRYPTION_CACHE_SIZE`` (default 0, i.e. disabled)
+    and ``DJANGO_FIELDS_DECRYPTION_CACHE_TTL`` settings.  Decrypted values
+    stay in memory while cached, so fields holding highly sensitive data
+    should be excluded with ``cache=False``.'''
+
+    def __init__(self, maxsize=0, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return None
+            # Re-inserting marks the entry as the most recently used one.
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+decryption_cache = DecryptionCache(
+    maxsize=getattr(settings, 'DJANGO_FIELDS_DECRYPTION_CACHE_SIZE', 0),
+    ttl=getattr(settings, 'DJANGO_FIELDS_DECRYPTION_CACHE_TTL', None),
+)
+
+PADDING_SCHEMES = ('printable', 'pkcs7')
+
+# Longer CBC values are encrypted one by one in encrypt_many().
+CBC_BATCH_MAX_BLOCKS = 16
+
+STORAGE_FORMATS = ('hex', 'base64', 'base85', 'binary')
+
+# Values stored in one of the compact formats ('base64', 'base85' and
+# 'binary') start with a 4 bytes header:
+#
+#   magic byte (0xDF), format version, cipher << 4 | block type, key id
+#
+# The key id is the id of the key in django_fields.keys.registry, or 0
+# for the key of the field.  'hex' values of other keys than 0 carry a
+# key marker ("k<id>$") after their prefix.
+#
+# Text formats prepend a short marker to the base64/base85 encoded value.
+# 'hex' is the original format: prefix + hex(iv + ciphertext).  Only
+# values with well-formed markers (HEX_MARKERS) after the cipher prefix,
+# a whole number of blocks and hex digits at both ends are taken for
+# encrypted values; anything else that starts with the prefix is plain
+# text.  The rest of the digits is checked when the value is decoded.
+#
+# In the AEAD modes (see AEAD_MODES) the iv + ciphertext part is made of
+# the nonce, the authentication tag and the unpadded ciphertext.
+#
+# The format of a stored value is told from its first bytes alone (see
+# BaseEncryptedField._classify), and the header is decoded from the
+# first characters of text values without decoding the rest.
+HEADER_MAGIC = b'\xdf'
+HEADER_VERSION = 1
+HEADER_SIZE = 4
+TEXT_MARKERS = {
+    'base64': '$b64$',
+    'base85': '$b85$',
+}
+TEXT_MARKER_LENGTH = 5
+HEX_MARKERS = re.compile(r'(?:(MODE_[A-Z0-9_]+)\$)?(?:k([0-9]{1,3})\$)?')
+HEX_DIGITS = re.compile(r'[0-9a-fA-F]*\Z')
+# Number of characters at each end of a 'hex' value checked by _parse_hex.
+HEX_CHECK_LENGTH = 32
+TEXT_FORMATS = dict(
+    (marker, storage) for storage, marker in TEXT_MARKERS.items())
+CIPHER_IDS = {
+    'AES': 1,
+    'ARC2': 2,
+    'Blowfish': 3,
+    'CAST': 4,
+    'DES': 5,
+    'DES3': 6,
+    'ChaCha20': 7,
+}
+BLOCK_TYPE_IDS = {
+    None: 0,
+    'MODE_ECB': 1,
+    'MODE_CBC': 2,
+    'MODE_CFB': 3,
+    'MODE_OFB': 5,
+    'MODE_GCM': 11,
+    'MODE_CHACHA20_POLY1305': 12,
+}
+BLOCK_TYPES_BY_ID = dict(
+    (block_type_id, block_type)
+    for block_type, block_type_id in BLOCK_TYPE_IDS.items()
+)
+
+if PYTHON3 is True:
+    BINARY_TYPES = (bytes, bytearray, memoryview)
+else:
+    BINARY_TYPES = (str, bytearray, memoryview, buffer)
+
+
+def _key_length(cipher_object):
+    '''Returns the longest key size (up to 32 bytes) of a cipher.'''
+    sizes = getattr(cipher_object, 'key_size', 32)
+    if isinstance(sizes, int):
+        return sizes
+    return max(size for size in sizes if size <= 32)
+
+
+def _to_bytes(value):
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return bytes(value)
+
+
+def _a2b_hex(text):
+    try:
+        return binascii.a2b_hex(text)
+    except (TypeError, binascii.Error):
+        raise ValueError("Value is not hex encoded")
+
+
+def _b64decode(text):
+    return base64.b64decode(text.encode('ascii'))
+
+
+def _b85decode(text):
+    if not hasattr(base64, 'b85decode'):
+        raise ValueError("base85 values require Python 3.4+")
+    return base64.b85decode(text.encode('ascii'))
+
+
+# Decoders of the compact formats, by format: the first one decodes the
+# header from the first characters of a value (base64 encodes 3 bytes
+# in 4 characters, base85 4 bytes in 5), the second one the whole value.
+HEADER_DECODERS = {
+    'binary': lambda value: _to_bytes(value[:HEADER_SIZE]),
+    'base64': lambda value: _b64decode(
+        value[TEXT_MARKER_LENGTH:TEXT_MARKER_LENGTH + 8])[:HEADER_SIZE],
+    'base85': lambda value: _b85decode(
+        value[TEXT_MARKER_LENGTH:TEXT_MARKER_LENGTH + 5]),
+}
+PAYLOAD_DECODERS = {
+    'binary': _to_bytes,
+    'base64': lambda value: _b64decode(value[TEXT_MARKER_LENGTH:]),
+    'base85': lambda value: _b85decode(value[TEXT_MARKER_LENGTH:]),
+}
 
 
 class BaseEncryptedField(models.Field):
@@ -41,10 +365,36 @@ class BaseEncryptedField(models.Field):
        You can find the original at http://www.djangosnippets.org/snippets/1095/'''
 
     def __init__(self, *args, **kwargs):
-        self.cipher_type = kwargs.pop('cipher', 'AES')
         self.block_type = kwargs.pop('block_type', None)
+        self.cipher_type = kwargs.pop(
+            'cipher', AEAD_MODES.get(self.block_type, 'AES'))
+        explicit_key = 'secret_key' in kwargs
         self.secret_key = kwargs.pop('secret_key', settings.SECRET_KEY)
+        self.blind_index = kwargs.pop('blind_index', False)
+        self.cache = kwargs.pop('cache', True)
+        self.lazy = kwargs.pop('lazy', False)
+        # Values of other block types than the field's are only read with
+        # accept_legacy=True, e.g. while upgrading them (see rotation).
+        self.accept_legacy = kwargs.pop('accept_legacy', False)
+        if self.blind_index:
+            self.blind_index_key = hmac.new(
+                smart_bytes(self.secret_key),
+                b'django_fields.blind_index',
+                hashlib.sha256,
+            ).digest()
         self.secret_key = self.secret_key[:32]
+        self.padding = kwargs.pop('padding', 'printable')
+        if self.padding not in PADDING_SCHEMES:
+            raise ValueError(
+                "Unknown padding scheme %r, use one of: %s" % (
+                    self.padding, ', '.join(PADDING_SCHEMES)))
+        self.storage = kwargs.pop('storage', 'hex')
+        if self.storage not in STORAGE_FORMATS:
+            raise ValueError(
+                "Unknown storage format %r, use one of: %s" % (
+                    self.storage, ', '.join(STORAGE_FORMATS)))
+        if self.storage == 'base85' and not hasattr(base64, 'b85encode'):
+            raise ValueError("'base85' storage requires Python 3.4+")
 
         if self.block_type is None:
             warnings.warn(
@@ -53,121 +403,871 @@ class BaseEncryptedField(models.Field):
                 "MODE_CBC). Please specify a secure block_type, such as CBC.",
                 DeprecationWarning,
             )
-        try:
-            imp = __import__('Crypto.Cipher', globals(), locals(), [self.cipher_type], -1)
-        except:
-            imp = __import__('Crypto.Cipher', globals(), locals(), [self.cipher_type])
-        self.cipher_object = getattr(imp, self.cipher_type)
+        # Fields keep no mutable cipher state: every encryption or
+        # decryption gets its own cipher object from the shared factory,
+        # so a field can be used from several threads at once.
+        # Values are encrypted with the active key of the key registry,
+        # unless the field has a key of its own (key id 0).
+        self._key_factories = {}
+        legacy = self.get_key_factory(0)
+        self.cipher_object = legacy.cipher_object
+        self.block_size = legacy.block_size
+        self.aead = legacy.aead is not None
+        self.cipher_prefix = '$%s$' % self.cipher_type
         if self.block_type:
             self.prefix = '$%s$%s$' % (self.cipher_type, self.block_type)
-            self.iv = Random.new().read(self.cipher_object.block_size)
-            self.cipher = self.cipher_object.new(
-                self.secret_key,
-                getattr(self.cipher_object, self.block_type),
-                self.iv)
         else:
-            self.cipher = self.cipher_object.new(self.secret_key)
             self.prefix = '$%s$' % self.cipher_type
+        # Maps the first 3 header bytes of the compact values of every
+        # block type of the cipher to the block type.
+        self._header_block_types = dict(
+            (HEADER_MAGIC + bytes(bytearray((
+                HEADER_VERSION,
+                CIPHER_IDS[self.cipher_type] << 4 | block_type_id))),
+             block_type)
+            for block_type, block_type_id in BLOCK_TYPE_IDS.items()
+            if self.cipher_type in CIPHER_IDS)
+        if (self.storage != 'hex' and (
+                self.cipher_type not in CIPHER_IDS or
+                self.block_type not in BLOCK_TYPE_IDS)):
+            raise ValueError(
+                "%r storage does not support cipher %s with block type %s" % (
+                    self.storage, self.cipher_type, self.block_type))
+        if explicit_key or not key_registry:
+            self._use_key(0)
+        else:
+            self._use_key(key_registry.active_key_id)
 
         self.original_max_length = max_length = kwargs.get('max_length', 40)
         self.unencrypted_length = max_length
-        # always add at least 2 to the max_length:
-        #     one for the null byte, one for padding
-        max_length += 2
-        mod = max_length % self.cipher.block_size
-        if mod > 0:
-            max_length += self.cipher.block_size - mod
-        if self.block_type:
-            max_length += len(self.iv)
-        kwargs['max_length'] = max_length * 2 + len(self.prefix)
+        if self.aead:
+            max_length += (self.cipher_factory.nonce_size +
+                           self.cipher_factory.tag_size)
+        else:
+            # always add at least 2 to the max_length:
+            #     one for the null byte, one for padding
+            max_length += 2
+            mod = max_length % self.block_size
+            if mod > 0:
+                max_length += self.block_size - mod
+            if self.block_type:
+                max_length += self.block_size
+        if self.storage == 'hex':
+            # Always leaves room for the key marker of any key id, so the
+            # column width doesn't change (without a migration) once keys
+            # are configured.
+            kwargs['max_length'] = (
+                max_length * 2 + len(self.prefix) + len('k%d$' % MAX_KEY_ID))
+        elif self.storage == 'base64':
+            kwargs['max_length'] = len(TEXT_MARKERS['base64']) + (
+                (HEADER_SIZE + max_length + 2) // 3 * 4)
+        elif self.storage == 'base85':
+            kwargs['max_length'] = len(TEXT_MARKERS['base85']) + (
+                (HEADER_SIZE + max_length + 3) // 4 * 5)
+        else:
+            kwargs['max_length'] = HEADER_SIZE + max_length
 
         super(BaseEncryptedField, self).__init__(*args, **kwargs)
 
+    def db_type(self, connection):
+        if self.storage == 'binary':
+            return models.BinaryField().db_type(connection)
+        return super(BaseEncryptedField, self).db_type(connection)
+
+    def _use_key(self, key_id):
+        '''Makes the field encrypt with the key ``key_id`` (0 for the key
+        of the field).'''
+        self.key_id = key_id
+        self.cipher_factory = self.get_key_factory(key_id)
+        if key_id:
+            self.hex_prefix = '%sk%d$' % (self.prefix, key_id)
+        else:
+            self.hex_prefix = self.prefix
+        if (self.cipher_type in CIPHER_IDS and
+                self.block_type in BLOCK_TYPE_IDS):
+            self.header = HEADER_MAGIC + bytes(bytearray((
+                HEADER_VERSION,
+                CIPHER_IDS[self.cipher_type] << 4 |
+                BLOCK_TYPE_IDS[self.block_type],
+                key_id,
+            )))
+        else:
+            self.header = None
+
+    def get_key_factory(self, key_id, block_type=NOT_PROVIDED):
+        '''Returns the ``CipherFactory`` for the key with id ``key_id``
+        and the field's block type, or the given ``block_type``.'''
+        if block_type is NOT_PROVIDED:
+            block_type = self.block_type
+        factory = self._key_factories.get((key_id, block_type))
+        if factory is None:
+            if key_id:
+                key = key_registry.derive(
+                    key_id, 'cipher.%s' % self.cipher_type,
+                    _key_length(self.get_key_factory(0).cipher_object))
+            else:
+                key = self.secret_key
+            factory = self._key_factories.setdefault(
+                (key_id, block_type),
+                get_cipher_factory(self.cipher_type, block_type, key))
+        return factory
+
+    def key_id_of(self, value):
+        '''Returns the id of the key a stored value was encrypted with,
+        or ``None`` if ``value`` is not encrypted.'''
+        try:
+            parsed = self._parse(value)
+        except ValueError:
+            return None
+        return parsed and parsed[2]
+
+    def needs_reencryption(self, value):
+        '''Tells whether a stored value differs from what the field writes
+        now: it was encrypted with another key than the active one, with
+        another block type (e.g. the legacy ECB default) or is stored in
+        another format.  See django_fields.rotation.'''
+        try:
+            parsed = self._parse(value)
+        except ValueError:
+            return False
+        return parsed is not None and parsed[:3] != (
+            self.storage, self.block_type, self.key_id)
+
     def _is_encrypted(self, value):
-        if PYTHON3 is True:
-            is_enc = isinstance(value, str) and value.startswith(self.prefix)
-            return is_enc
+        '''Tells whether ``value`` was encrypted with the field's cipher
+        and a block type the field reads, from its type, first bytes and
+        length only.'''
+        try:
+            inspected = self._inspect(value)
+        except ValueError:
+            return False
+        return inspected is not None and self._reads_block_type(inspected[1])
+
+    def _reads_block_type(self, block_type):
+        return block_type == self.block_type or self.accept_legacy
+
+    def _check_block_type(self, block_type):
+        '''Raises ``ValueError`` for values encrypted with another block
+        type than the field's, unless the field has ``accept_legacy=True``.
+        Such values can't be trusted by fields with an AEAD mode: e.g. CBC
+        values can be altered without knowing the key.'''
+        if not self._reads_block_type(block_type):
+            raise ValueError(
+                "Value was encrypted with block type %s instead of %s; "
+                "fields with accept_legacy=True read it" % (
+                    block_type, self.block_type))
+
+    def _classify(self, value):
+        '''Returns the storage format of a stored value and the value
+        itself (as text for the text formats), or ``None`` for values
+        which are not encrypted with the field's cipher.  Only the type
+        and the first bytes of ``value`` are looked at.
+
+        Text formats handed over as bytes, e.g. by database drivers
+        returning bytes for text columns, are recognised too.'''
+        if isinstance(value, BINARY_TYPES):
+            if value[:1] == HEADER_MAGIC:
+                return 'binary', value
+            # Python 2 byte strings are text as well.
+            if not isinstance(value, string_types):
+                if value[:1] != b'$':
+                    return None
+                try:
+                    value = _to_bytes(value).decode('ascii')
+                except UnicodeDecodeError:
+                    return None
+        elif not isinstance(value, string_types):
+            return None
+        if value[:1] != '$':
+            return None
+        storage = TEXT_FORMATS.get(value[:TEXT_MARKER_LENGTH])
+        if storage is not None:
+            return storage, value
+        if value[:len(self.cipher_prefix)] == self.cipher_prefix:
+            return 'hex', value
+        return None
+
+    def _read_header(self, storage, value):
+        '''Returns (block type, key id) from the header of a value in one
+        of the compact formats, or ``None`` if it has no valid header.
+        Raises ``ValueError`` for values of another cipher or format
+        version.'''
+        try:
+            header = HEADER_DECODERS[storage](value)
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        if header[:1] != HEADER_MAGIC or len(header) < HEADER_SIZE:
+            return None
+        try:
+            block_type = self._header_block_types[header[:3]]
+        except KeyError:
+            raise ValueError(
+                "Value was encrypted with a different cipher or format "
+                "version than the field uses")
+        return block_type, bytearray(header)[3]
+
+    def _parse_hex(self, value):
+        '''Returns (block type, key id, hex payload) of a value in the
+        'hex' format, or ``None`` if the rest of the value after the
+        cipher prefix doesn't look like an encrypted value.  Only the
+        markers, the length and the digits at both ends of the payload
+        are checked.'''
+        match = HEX_MARKERS.match(value, len(self.cipher_prefix))
+        block_type, key_id = match.groups()
+        key_id = int(key_id or 0)
+        text = value[match.end():]
+        if (len(text) % 2 or block_type not in BLOCK_TYPE_IDS or
+                key_id > MAX_KEY_ID or
+                not self._fits_block_type(block_type, len(text) // 2) or
+                not HEX_DIGITS.match(text[:HEX_CHECK_LENGTH]) or
+                not HEX_DIGITS.match(text[-HEX_CHECK_LENGTH:])):
+            return None
+        return block_type, key_id, text
+
+    def _fits_block_type(self, block_type, size):
+        '''Tells whether ``size`` bytes of iv + ciphertext can have been
+        written with ``block_type``.'''
+        try:
+            factory = self.get_key_factory(0, block_type)
+        except ValueError:
+            return False
+        if factory.aead is not None:
+            return size >= factory.nonce_size + factory.tag_size
+        if size % factory.block_size:
+            return False
+        return size >= factory.block_size * (2 if block_type else 1)
+
+    def _inspect(self, value):
+        '''Returns (format, block type, key id, value) for a value stored
+        with the field's cipher, or ``None`` if ``value`` is not
+        encrypted.  The value is returned as text for the text formats,
+        and as the hex payload (without prefix) for the 'hex' format.
+
+        Only the type, the first bytes and (for 'hex') the length of
+        ``value`` are looked at; the result can be handed on to
+        ``_parse``, ``_decode`` and ``_cache_key``, so that values are
+        inspected once.  Raises ``ValueError`` for compact values of
+        another cipher or format version.'''
+        classified = self._classify(value)
+        if classified is None:
+            return None
+        storage, value = classified
+        if storage == 'hex':
+            parsed = self._parse_hex(value)
+            if parsed is None:
+                return None
+            return ('hex',) + parsed
+        header = self._read_header(storage, value)
+        if header is None:
+            return None
+        return storage, header[0], header[1], value
+
+    def _parse(self, value, inspected=NOT_PROVIDED):
+        '''Returns (format, block type, key id, payload) of a value stored
+        with the field's cipher, or ``None`` if ``value`` is not
+        encrypted.  The payload is the hex encoded iv + ciphertext for
+        the 'hex' format, iv + ciphertext otherwise.
+
+        Values written with any block type are recognised, so that
+        ``needs_reencryption`` finds values written before the block type
+        of the field was changed; they are only decrypted by fields with
+        ``accept_legacy=True`` (see ``_check_block_type``).  Raises
+        ``ValueError`` for compact values of another cipher or format
+        version.'''
+        if inspected is NOT_PROVIDED:
+            inspected = self._inspect(value)
+        if inspected is None:
+            return None
+        storage, block_type, key_id, value = inspected
+        if storage == 'hex':
+            return inspected
+        try:
+            blob = PAYLOAD_DECODERS[storage](value)
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        return storage, block_type, key_id, blob[HEADER_SIZE:]
+
+    def _decode(self, value, inspected=NOT_PROVIDED):
+        '''Returns (block type, key id, iv + ciphertext) for a stored value
+        in any format, or ``None`` if ``value`` is not encrypted.  Raises
+        ``ValueError`` for values the field doesn't read.'''
+        parsed = self._parse(value, inspected)
+        if parsed is None:
+            return None
+        storage, block_type, key_id, payload = parsed
+        self._check_block_type(block_type)
+        if storage == 'hex':
+            payload = _a2b_hex(payload)
+        return block_type, key_id, payload
+
+    def _encode(self, value, connection=None):
+        '''Converts iv + ciphertext into the configured storage format.'''
+        if self.storage == 'hex':
+            if PYTHON3 is True:
+                return self.hex_prefix + binascii.b2a_hex(value).decode('utf-8')
+            return self.hex_prefix + binascii.b2a_hex(value)
+        value = self.header + value
+        if self.storage == 'binary':
+            if connection is not None:
+                return connection.Database.Binary(value)
+            return value
+        if self.storage == 'base64':
+            value = base64.b64encode(value)
         else:
-            return isinstance(value, basestring) and value.startswith(
-                self.prefix)
+            value = base64.b85encode(value)
+        return TEXT_MARKERS[self.storage] + value.decode('ascii')
 
     def _get_padding(self, value):
         # We always want at least 2 chars of padding (including zero byte),
         # so we could have up to block_size + 1 chars.
-        mod = (len(value) + 2) % self.cipher.block_size
-        return self.cipher.block_size - mod + 2
+        mod = (len(value) + 2) % self.block_size
+        return self.block_size - mod + 2
+
+    def _pad_many(self, values):
+        '''Pads byte strings up to the cipher block size.
+
+        With the default ``'printable'`` scheme a value is followed by a
+        null byte and random printable characters; all of them are
+        taken from a single random block for the whole list.  The
+        ``'pkcs7'`` scheme needs no random data at all.'''
+        if self.padding == 'pkcs7':
+            padded = []
+            for value in values:
+                count = self.block_size - len(value) % self.block_size
+                padded.append(value + bytes(bytearray((count,))) * count)
+            return padded
+
+        paddings = [self._get_padding(value) for value in values]
+        noise = random_printable(sum(paddings) - len(paddings))
+        padded = []
+        offset = 0
+        for value, padding in zip(values, paddings):
+            padded.append(
+                value + b'\0' + noise[offset:offset + padding - 1])
+            offset += padding - 1
+        return padded
+
+    def _unpad(self, value, block_size=None):
+        '''Strips the padding added by either padding scheme.
+
+        PKCS#7 padding is recognised by its trailing bytes.  Padding of
+        the ``'printable'`` scheme ends with a random printable
+        character, and could only look like PKCS#7 padding if its last
+        nine or more random characters were all the same whitespace
+        character, so values of both schemes can be read back without
+        knowing which one the field was configured with.'''
+        block_size = block_size or self.block_size
+        count = bytearray(value[-1:])[0]
+        if 0 < count <= block_size and value[-count:] == value[-1:] * count:
+            return value[:-count]
+        return value.split(b'\0')[0]
+
+    def _cache_key(self, value, inspected=NOT_PROVIDED):
+        '''Returns the ``decryption_cache`` key for a stored value, or
+        ``None`` if it can't be cached.  Values which are not encrypted
+        are never cached.'''
+        if not self.cache or not decryption_cache.maxsize:
+            return None
+        if isinstance(value, BINARY_TYPES) and not isinstance(value, string_types):
+            value = _to_bytes(value)
+        elif not isinstance(value, string_types):
+            return None
+        if inspected is NOT_PROVIDED:
+            if not self._is_encrypted(value):
+                return None
+        elif inspected is None or not self._reads_block_type(inspected[1]):
+            return None
+        return (self.cipher_factory, value)
 
     def from_db_value(self, value, expression, connection, context):
-        if self._is_encrypted(value):
-            if self.block_type:
-                self.iv = binascii.a2b_hex(value[len(self.prefix):])[:len(self.iv)]
-                self.cipher = self.cipher_object.new(
-                    self.secret_key,
-                    getattr(self.cipher_object, self.block_type),
-                    self.iv)
-                decrypt_value = binascii.a2b_hex(value[len(self.prefix):])[len(self.iv):]
+        return self._from_plaintext(self._decrypt_cached(value))
+
+    def _decrypt_cached(self, value):
+        '''Decrypts a stored value, through the ``decryption_cache``.'''
+        inspected = self._inspect(value)
+        if inspected is None:
+            return value
+        key = self._cache_key(value, inspected)
+        if key is None:
+            return self._decrypt(value, inspected)
+        plaintext = decryption_cache.get(key)
+        if plaintext is None:
+            plaintext = self._decrypt(value, inspected)
+            decryption_cache.set(key, plaintext)
+        return plaintext
+
+    def _decrypt(self, value, inspected=NOT_PROVIDED):
+        decoded = self._decode(value, inspected)
+        if decoded is None:
+            return value
+        return self._decrypt_body(*decoded)
+
+    def _decrypt_body(self, block_type, key_id, decrypt_value):
+        '''Decrypts the iv + ciphertext of a single value.'''
+        start = metrics.timer() if metrics.enabled else None
+        factory = self.get_key_factory(key_id, block_type)
+        size = len(decrypt_value)
+        if factory.aead is not None:
+            plaintext = self._decode_plaintext(
+                self._open(factory, decrypt_value))
+            if start is not None:
+                metrics.record(self, 'decrypt', 1, size, start)
+            return plaintext
+        block_size = factory.block_size
+        if block_type:
+            cipher = factory.new(decrypt_value[:block_size])
+            decrypt_value = decrypt_value[block_size:]
+        else:
+            cipher = factory.new()
+        plaintext = self._decode_plaintext(
+            self._unpad(cipher.decrypt(decrypt_value), block_size))
+        if start is not None:
+            metrics.record(self, 'decrypt', 1, size, start)
+        return plaintext
+
+    def _seal(self, nonce, value):
+        '''Encrypts and authenticates ``value`` in an AEAD mode, giving
+        nonce + tag + ciphertext.'''
+        sealed = self.cipher_factory.aead.encrypt(nonce, value)
+        tag_size = self.cipher_factory.tag_size
+        return nonce + sealed[-tag_size:] + sealed[:-tag_size]
+
+    def _open(self, factory, body):
+        '''Checks and decrypts nonce + tag + ciphertext in an AEAD mode,
+        in one pass.  Raises ``ValueError`` for values which were
+        tampered with or encrypted with another key.'''
+        nonce_size = factory.nonce_size
+        tag_end = nonce_size + factory.tag_size
+        return factory.aead.decrypt(
+            body[:nonce_size], body[tag_end:] + body[nonce_size:tag_end])
+
+    def _decode_many(self, values, inspected=None):
+        '''Returns (indexes, iv + ciphertexts, (key id, block type) pairs)
+        of the encrypted ``values``; ``inspected`` optionally holds the
+        results of ``_inspect`` for every value.
+
+        Values in the hex format are decoded with a single ``a2b_hex``
+        call for the whole list.'''
+        if inspected is None:
+            inspected = [self._inspect(value) for value in values]
+        hex_values = []
+        decoded = {}
+        for i, value in enumerate(values):
+            parsed = self._parse(value, inspected[i])
+            if parsed is None:
+                continue
+            storage, block_type, key_id, payload = parsed
+            self._check_block_type(block_type)
+            if storage == 'hex':
+                hex_values.append((i, (key_id, block_type), payload))
             else:
-                decrypt_value = binascii.a2b_hex(value[len(self.prefix):])
-            return force_unicode(
-                self.cipher.decrypt(decrypt_value).split(b'\0')[0]
-            )
+                decoded[i] = ((key_id, block_type), payload)
+        if hex_values:
+            raw = _a2b_hex(''.join(text for i, kind, text in hex_values))
+            offset = 0
+            for i, kind, text in hex_values:
+                length = len(text) // 2
+                decoded[i] = (kind, raw[offset:offset + length])
+                offset += length
+        indexes = sorted(decoded)
+        return (indexes, [decoded[i][1] for i in indexes],
+                [decoded[i][0] for i in indexes])
+
+    def decrypt_many(self, values):
+        '''Decrypts a list of values read from the database.
+
+        Values found in the ``decryption_cache`` are taken from there; all
+        others are decrypted in one pass by ``_decrypt_many``.'''
+        values = list(values)
+        if not self.cache or not decryption_cache.maxsize:
+            return self._decrypt_many(values)
+        inspected = [self._inspect(value) for value in values]
+        keys = [self._cache_key(value, inspection)
+                for value, inspection in zip(values, inspected)]
+        misses = []
+        for index, key in enumerate(keys):
+            if key is not None:
+                plaintext = decryption_cache.get(key)
+                if plaintext is not None:
+                    values[index] = plaintext
+                    continue
+            misses.append(index)
+        decrypted = self._decrypt_many(
+            [values[index] for index in misses],
+            [inspected[index] for index in misses])
+        for index, plaintext in zip(misses, decrypted):
+            values[index] = plaintext
+            if keys[index] is not None:
+                decryption_cache.set(keys[index], plaintext)
+        return values
+
+    def _decrypt_many(self, values, inspected=None):
+        '''Decrypts a list of values read from the database in one pass.
+
+        All ciphertexts are decoded (see ``_decode_many``) and decrypted
+        with a single cipher call per key and block type.  CBC values are
+        decrypted with one ECB pass over the whole buffer, followed by
+        xor-ing each block with the preceding ciphertext block (or IV).
+        Values which are not encrypted (e.g. ``None``) are returned
+        unchanged.'''
+        values = list(values)
+        start = metrics.timer() if metrics.enabled else None
+        indexes, bodies, kinds = self._decode_many(values, inspected)
+
+        groups = OrderedDict()
+        for i, body, kind in zip(indexes, bodies, kinds):
+            group = groups.setdefault(kind, ([], []))
+            group[0].append(i)
+            group[1].append(body)
+        count = size = 0
+        for (key_id, block_type), (group_indexes, group_bodies) in groups.items():
+            if block_type is None or (
+                    block_type == 'MODE_CBC' and PYTHON3 is True):
+                self._decrypt_bodies(
+                    self.get_key_factory(key_id, block_type),
+                    values, group_indexes, group_bodies)
+                count += len(group_indexes)
+                size += sum(len(body) for body in group_bodies)
+            else:
+                # _decrypt_body reports every value itself.
+                for i, body in zip(group_indexes, group_bodies):
+                    values[i] = self._decrypt_body(block_type, key_id, body)
+        if start is not None and count:
+            metrics.record(self, 'decrypt', count, size, start)
+        return values
+
+    def _decrypt_bodies(self, factory, values, indexes, bodies):
+        '''Decrypts ECB or CBC ``bodies`` with one cipher call and stores
+        the plaintexts at ``indexes`` of ``values``.'''
+        raw = b''.join(bodies)
+        block_size = factory.block_size
+        if not factory.block_type:
+            decrypted = factory.ecb().decrypt(raw)
+            offset = 0
+            for i, body in zip(indexes, bodies):
+                values[i] = self._decode_plaintext(self._unpad(
+                    decrypted[offset:offset + len(body)], block_size))
+                offset += len(body)
+        else:
+            decrypted = factory.ecb().decrypt(raw)[block_size:]
+            plain = _xor(decrypted, raw[:-block_size])
+            offset = 0
+            for i, body in zip(indexes, bodies):
+                values[i] = self._decode_plaintext(self._unpad(
+                    plain[offset:offset + len(body) - block_size], block_size))
+                offset += len(body)
+
+    def from_db_values(self, values, connection=None):
+        '''Batch counterpart of ``from_db_value``: decrypts all ``values``
+        with ``decrypt_many`` and converts them to python values.'''
+        return [
+            self._from_plaintext(plaintext)
+            for plaintext in self.decrypt_many(values)
+        ]
+
+    def _from_plaintext(self, value):
+        '''Converts a decrypted plaintext into a python value.
+        Subclasses for non-text values override this.'''
         return value
 
+    def _to_plaintext(self, value):
+        '''Converts a python value into the text (or bytes) which gets
+        encrypted.  Subclasses for non-text values override this.'''
+        return value
+
+    def _decode_plaintext(self, value):
+        '''Converts decrypted bytes into the plaintext returned by the
+        decryption methods.  Subclasses encrypting bytes override this.'''
+        return force_unicode(value)
+
+    def _encrypt_cbc_many(self, ivs, values):
+        '''CBC-encrypts padded ``values`` with the matching ``ivs``.
+
+        Short values are encrypted block by block for the whole batch:
+        one ECB call encrypts the n-th block of every value, chained by
+        xor-ing it with the previous ciphertext blocks.  This avoids a
+        cipher object (and key schedule) per value.'''
+        block_size = self.block_size
+        ecb = self.cipher_factory.ecb()
+        bodies = [None] * len(values)
+        groups = {}
+        for index, value in enumerate(values):
+            groups.setdefault(len(value) // block_size, []).append(index)
+        for blocks, indexes in groups.items():
+            if len(indexes) == 1 or blocks > CBC_BATCH_MAX_BLOCKS or PYTHON3 is False:
+                for index in indexes:
+                    bodies[index] = ivs[index] + self.cipher_factory.new(
+                        ivs[index]).encrypt(values[index])
+                continue
+            previous = b''.join(ivs[index] for index in indexes)
+            rounds = []
+            for block in range(blocks):
+                start = block * block_size
+                plain = b''.join(
+                    values[index][start:start + block_size]
+                    for index in indexes)
+                previous = ecb.encrypt(_xor(plain, previous))
+                rounds.append(previous)
+            for position, index in enumerate(indexes):
+                start = position * block_size
+                bodies[index] = ivs[index] + b''.join(
+                    encrypted[start:start + block_size]
+                    for encrypted in rounds)
+        return bodies
+
+    def encrypt_many(self, values, connection=None):
+        '''Encrypts a list of python values for storing in the database.
+
+        Padding and IVs for the whole list are taken from single random
+        blocks, ECB values are encrypted with a single cipher call, and
+        values in the hex format are encoded with a single ``b2a_hex``
+        call.  ``None``, already encrypted values and the values of
+        ``StoredValue`` objects are returned unchanged.'''
+        values = list(values)
+        indexes = []
+        plaintexts = []
+        for index, value in enumerate(values):
+            if isinstance(value, StoredValue):
+                values[index] = value.value
+                continue
+            if value is None or self._is_encrypted(value):
+                continue
+            value = self._to_plaintext(value)
+            if value is None:
+                values[index] = None
+                continue
+            if PYTHON3 is True:
+                if not isinstance(value, bytes):
+                    value = value.encode('utf-8')
+            else:
+                value = smart_str(value)
+            indexes.append(index)
+            plaintexts.append(value)
+        for index, value in zip(
+                indexes, self._encrypt_plaintexts(plaintexts, connection)):
+            values[index] = value
+        return values
+
+    def _encrypt_plaintexts(self, plaintexts, connection=None):
+        '''Encrypts a list of byte strings (see ``encrypt_many``) and
+        returns them in the storage format.'''
+        if not plaintexts:
+            return []
+        start = metrics.timer() if metrics.enabled else None
+        if self.aead:
+            nonce_size = self.cipher_factory.nonce_size
+            nonces = random_pool.read(nonce_size * len(plaintexts))
+            bodies = [
+                self._seal(nonces[offset:offset + nonce_size], value)
+                for offset, value in zip(
+                    range(0, len(nonces), nonce_size), plaintexts)
+            ]
+        elif self.block_type:
+            padded = self._pad_many(plaintexts)
+            # A fresh IV for every value; reusing one IV leaks equal
+            # plaintext prefixes.
+            block_size = self.block_size
+            random_ivs = random_pool.read(block_size * len(padded))
+            ivs = [random_ivs[offset:offset + block_size]
+                   for offset in range(0, len(random_ivs), block_size)]
+            if self.block_type == 'MODE_CBC':
+                bodies = self._encrypt_cbc_many(ivs, padded)
+            else:
+                bodies = [iv + self.cipher_factory.new(iv).encrypt(value)
+                          for iv, value in zip(ivs, padded)]
+        else:
+            padded = self._pad_many(plaintexts)
+            encrypted = self.cipher_factory.ecb().encrypt(b''.join(padded))
+            bodies = []
+            offset = 0
+            for value in padded:
+                bodies.append(encrypted[offset:offset + len(value)])
+                offset += len(value)
+
+        if self.storage == 'hex':
+            encoded = binascii.b2a_hex(b''.join(bodies))
+            if PYTHON3 is True:
+                encoded = encoded.decode('utf-8')
+            values = []
+            offset = 0
+            for body in bodies:
+                values.append(self.hex_prefix + encoded[offset:offset + len(body) * 2])
+                offset += len(body) * 2
+        else:
+            values = [self._encode(body, connection) for body in bodies]
+        if start is not None:
+            metrics.record(self, 'encrypt', len(bodies),
+                           sum(len(body) for body in bodies), start)
+        return values
+
     def get_db_prep_value(self, value, connection=None, prepared=False):
+        return self.encrypt_many([value], connection)[0]
+
+    @property
+    def blind_index_name(self):
+        return '%s_bidx' % self.name
+
+    def blind_index_digest(self, value):
+        '''Returns the blind index (a keyed HMAC-SHA256) of a python value.'''
         if value is None:
             return None
+        if hasattr(value, 'resolve_expression'):
+            raise ValueError(
+                "Blind indexes of %s can only be looked up with plain "
+                "values" % self.name)
+        value = self._to_plaintext(value)
+        if value is None:
+            return None
+        return hmac.new(
+            self.blind_index_key, smart_bytes(value), hashlib.sha256
+        ).hexdigest()
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(BaseEncryptedField, self).contribute_to_class(
+            cls, name, *args, **kwargs)
+        # Models rendered from migrations (module "__fake__") already have
+        # the index field in their migration state.
+        if (self.blind_index and not cls._meta.abstract and
+                cls.__module__ != '__fake__'):
+            cls.add_to_class(self.blind_index_name, BlindIndexField(source=name))
+        if self.lazy:
+            setattr(cls, self.attname, LazyDecryptionDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        if self.lazy:
+            value = model_instance.__dict__.get(self.attname)
+            if isinstance(value, StoredValue):
+                # Don't decrypt values which were never accessed; they are
+                # saved as they were loaded.
+                return value
+        return super(BaseEncryptedField, self).pre_save(model_instance, add)
 
-        if PYTHON3 is True:
-            value = bytes(value.encode('utf-8'))
-        else:
-            value = smart_str(value)
-
-        if not self._is_encrypted(value):
-            padding = self._get_padding(value)
-            if padding > 0:
-                if PYTHON3 is True:
-                    value += bytes("\0".encode('utf-8')) + bytes(
-                        ''.encode('utf-8')).join([
-                            bytes(random.choice(
-                                string.printable).encode('utf-8'))
-                            for index in range(padding - 1)])
-                else:
-                    value += "\0" + ''.join([
-                        random.choice(string.printable)
-                        for index in range(padding - 1)
-                    ])
-            if self.block_type:
-                self.cipher = self.cipher_object.new(
-                    self.secret_key,
-                    getattr(self.cipher_object, self.block_type),
-                    self.iv)
-                if PYTHON3 is True:
-                    value = self.prefix + binascii.b2a_hex(
-                        self.iv + self.cipher.encrypt(value)).decode('utf-8')
-                else:
-                    value = self.prefix + binascii.b2a_hex(
-                        self.iv + self.cipher.encrypt(value))
-            else:
-                if PYTHON3 is True:
-                    value = self.prefix + binascii.b2a_hex(
-                        self.cipher.encrypt(value)).decode('utf-8')
-                else:
-                    value = self.prefix + binascii.b2a_hex(
-                        self.cipher.encrypt(value))
-        return value
+    def get_lookup(self, lookup_name):
+        if self.blind_index and lookup_name in BLIND_INDEX_LOOKUPS:
+            return BLIND_INDEX_LOOKUPS[lookup_name]
+        return super(BaseEncryptedField, self).get_lookup(lookup_name)
 
     def deconstruct(self):
         original = super(BaseEncryptedField, self).deconstruct()
         kwargs = original[-1]
+        if self.blind_index:
+            kwargs['blind_index'] = True
+        if not self.cache:
+            kwargs['cache'] = False
+        if self.lazy:
+            kwargs['lazy'] = True
+        if self.accept_legacy:
+            kwargs['accept_legacy'] = True
         if self.cipher_type != 'AES':
             kwargs['cipher'] = self.cipher_type
         if self.block_type is not None:
             kwargs['block_type'] = self.block_type
+        if self.padding != 'printable':
+            kwargs['padding'] = self.padding
+        if self.storage != 'hex':
+            kwargs['storage'] = self.storage
         if self.original_max_length != 40:
             kwargs['max_length'] = self.original_max_length
         return original[:-1] + (kwargs,)
 
 
+class StoredValue(object):
+    '''The value of a field with ``lazy=True`` as it was loaded from the
+    database, before its first access.'''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class LazyDecryptionDescriptor(object):
+    '''Model attribute of encrypted fields with ``lazy=True``.
+
+    Model instances loaded through ``EncryptedQuerySet`` hold the stored
+    values of such fields as ``StoredValue`` objects; the value goes
+    through ``from_db_value`` on first access (raising the same errors as
+    for other fields) and the result replaces it on the instance.'''
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            instance.refresh_from_db(fields=[attname])
+        value = instance.__dict__[attname]
+        if isinstance(value, StoredValue):
+            value = self.field.from_db_value(value.value, None, None, None)
+            instance.__dict__[attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class BlindIndexField(models.CharField):
+    '''Holds the blind index of an encrypted field with
+    ``blind_index=True``; such fields add it to their model as
+    ``<name>_bidx``.  Equality lookups on the encrypted field are
+    translated into lookups on this indexed column.'''
+
+    def __init__(self, *args, **kwargs):
+        self.source = kwargs.pop('source', None)
+        kwargs.setdefault('max_length', 64)
+        kwargs.setdefault('db_index', True)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('editable', False)
+        super(BlindIndexField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        source = model_instance._meta.get_field(self.source)
+        if isinstance(model_instance.__dict__.get(source.attname), StoredValue):
+            # Not accessed since it was loaded, the index is unchanged.
+            return getattr(model_instance, self.attname)
+        value = getattr(model_instance, source.attname)
+        if source._is_encrypted(value):
+            # Already encrypted (e.g. by EncryptedQuerySet.bulk_create),
+            # the index was computed beforehand.
+            return getattr(model_instance, self.attname)
+        digest = source.blind_index_digest(value)
+        setattr(model_instance, self.attname, digest)
+        return digest
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(BlindIndexField, self).deconstruct()
+        kwargs['source'] = self.source
+        for key, default in (('max_length', 64), ('db_index', True),
+                             ('null', True), ('editable', False)):
+            if kwargs.get(key) == default:
+                del kwargs[key]
+        return name, path, args, kwargs
+
+
+class BlindIndexExact(lookups.Exact):
+    def __init__(self, lhs, rhs):
+        field = lhs.output_field
+        index_field = field.model._meta.get_field(field.blind_index_name)
+        super(BlindIndexExact, self).__init__(
+            Col(lhs.alias, index_field), field.blind_index_digest(rhs))
+
+
+class BlindIndexIn(lookups.In):
+    def __init__(self, lhs, rhs):
+        field = lhs.output_field
+        index_field = field.model._meta.get_field(field.blind_index_name)
+        super(BlindIndexIn, self).__init__(
+            Col(lhs.alias, index_field),
+            [field.blind_index_digest(value) for value in rhs])
+
+
+BLIND_INDEX_LOOKUPS = {
+    'exact': BlindIndexExact,
+    'in': BlindIndexIn,
+}
+
+
 class EncryptedTextField(BaseEncryptedField):
 
     def get_internal_type(self):
@@ -189,18 +1289,44 @@ class EncryptedCharField(BaseEncryptedField):
         defaults.update(kwargs)
         return super(EncryptedCharField, self).formfield(**defaults)
 
-    def get_db_prep_value(self, value, connection=None, prepared=False):
-        if value is not None and not self._is_encrypted(value):
-            if len(value) > self.unencrypted_length:
-                raise ValueError(
-                    "Field value longer than max allowed: " +
-                    str(len(value)) + " > " + str(self.unencrypted_length)
-                )
-        return super(EncryptedCharField, self).get_db_prep_value(
-            value,
-            connection=connection,
-            prepared=prepared,
-        )
+    def _to_plaintext(self, value):
+        if len(value) > self.unencrypted_length:
+            raise ValueError(
+                "Field value longer than max allowed: " +
+                str(len(value)) + " > " + str(self.unencrypted_length)
+            )
+        return value
+
+
+def _pop_compact(kwargs):
+    '''Pops the ``compact`` argument of fields which can pack their values
+    into bytes.  Packed values contain null bytes, which the 'printable'
+    padding scheme can't be told apart from, so they need 'pkcs7'.'''
+    compact = kwargs.pop('compact', False)
+    if compact and kwargs.setdefault('padding', 'pkcs7') != 'pkcs7':
+        raise ValueError("compact=True requires 'pkcs7' padding")
+    return compact
+
+
+if PYTHON3 is True:
+    def _int_to_bytes(value):
+        '''Returns the shortest big-endian two's complement of ``value``.'''
+        return value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+
+    def _int_from_bytes(value):
+        return int.from_bytes(value, 'big', signed=True)
+else:
+    def _int_to_bytes(value):
+        length = (value.bit_length() + 8) // 8
+        if value < 0:
+            value += 1 << (length * 8)
+        return binascii.a2b_hex('%0*x' % (length * 2, value))
+
+    def _int_from_bytes(value):
+        number = long(binascii.b2a_hex(value), 16)
+        if bytearray(value[:1])[0] & 0x80:
+            number -= 1 << (len(value) * 8)
+        return number
 
 
 class BaseEncryptedDateField(BaseEncryptedField):
@@ -209,8 +1335,17 @@ class BaseEncryptedDateField(BaseEncryptedField):
     # If you try to inherit from a class with a __metaclass__, you'll
     # get a very opaque infinite recursion in contribute_to_class.
 
+    # With compact=True values are packed into a few bytes (see _pack)
+    # instead of being formatted with strftime, so they fit in a single
+    # cipher block.  Fields read values of both encodings, told apart by
+    # their length (``packed_sizes``).
+
     def __init__(self, *args, **kwargs):
-        kwargs['max_length'] = self.max_raw_length
+        self.compact = _pop_compact(kwargs)
+        if self.compact:
+            kwargs['max_length'] = max(self.packed_sizes)
+        else:
+            kwargs['max_length'] = self.max_raw_length
         super(BaseEncryptedDateField, self).__init__(*args, **kwargs)
 
     def get_internal_type(self):
@@ -224,32 +1359,51 @@ class BaseEncryptedDateField(BaseEncryptedField):
     def to_python(self, value):
         return self.from_db_value(value)
 
-    def from_db_value(self, value, expression, connection, context):
-        # value is either a date or a string in the format "YYYY:MM:DD"
+    def _from_plaintext(self, value):
+        # value is either a date, packed bytes or a string in the format
+        # "YYYY:MM:DD"
 
         if value in fields.EMPTY_VALUES:
             date_value = value
         else:
             if isinstance(value, self.date_class):
                 date_value = value
+            elif (isinstance(value, bytes) and
+                    len(value) in self.packed_sizes):
+                date_value = self._unpack(value)
             else:
-                date_text = super(BaseEncryptedDateField, self).from_db_value(
-                    value, expression, connection, context)
-                date_value = self.date_class(*map(int, date_text.split(':')))
+                date_value = self.date_class(*map(int, value.split(':')))
         return date_value
 
-    def get_db_prep_value(self, value, connection=None, prepared=False):
+    def _decode_plaintext(self, value):
+        if len(value) in self.packed_sizes:
+            return value
+        return force_unicode(value)
+
+    def _to_plaintext(self, value):
         # value is a date_class.
         # We need to convert it to a string in the format "YYYY:MM:DD"
         if value:
-            date_text = value.strftime(self.save_format)
-        else:
-            date_text = None
-        return super(BaseEncryptedDateField, self).get_db_prep_value(
-            date_text,
-            connection=connection,
-            prepared=prepared
-        )
+            if self.compact:
+                return self._pack(value)
+            return value.strftime(self.save_format)
+        return None
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(
+            BaseEncryptedDateField, self).deconstruct()
+        if self.compact:
+            kwargs['compact'] = True
+        return name, path, args, kwargs
+
+
+# Days since 0001-01-01 (the date ordinal).
+DATE_STRUCT = struct.Struct('>I')
+# Microseconds since 0001-01-01 00:00, in UTC for aware values, which
+# are followed by their UTC offset in minutes.
+DATETIME_STRUCT = struct.Struct('>q')
+DATETIME_TZ_STRUCT = struct.Struct('>qh')
+MICROSECONDS_PER_DAY = 24 * 60 * 60 * 10 ** 6
 
 
 class EncryptedDateField(BaseEncryptedDateField):
@@ -258,22 +1412,90 @@ class EncryptedDateField(BaseEncryptedDateField):
     save_format = "%Y:%m:%d"
     date_class = datetime.date
     max_raw_length = 10  # YYYY:MM:DD
+    packed_sizes = (DATE_STRUCT.size,)
+
+    def _pack(self, value):
+        return DATE_STRUCT.pack(value.toordinal())
+
+    def _unpack(self, value):
+        return datetime.date.fromordinal(DATE_STRUCT.unpack(value)[0])
 
 
 class EncryptedDateTimeField(BaseEncryptedDateField):
-    # FIXME:  This doesn't handle time zones, but Python doesn't really either.
+    # Time zones are only kept with compact=True, as a fixed UTC offset.
     form_widget = forms.DateTimeInput
     form_field = forms.DateTimeField
     save_format = "%Y:%m:%d:%H:%M:%S:%f"
     date_class = datetime.datetime
     max_raw_length = 26  # YYYY:MM:DD:hh:mm:ss:micros
+    packed_sizes = (DATETIME_STRUCT.size, DATETIME_TZ_STRUCT.size)
+
+    def _pack(self, value):
+        offset = value.utcoffset()
+        if offset is not None:
+            try:
+                value -= offset
+            except OverflowError:
+                raise ValueError(
+                    "%s is out of the datetime range in UTC" % (value,))
+            minutes, seconds = divmod(
+                offset.days * 24 * 60 * 60 + offset.seconds, 60)
+            if seconds or offset.microseconds:
+                raise ValueError(
+                    "UTC offsets of whole minutes only can be stored")
+        microseconds = (
+            (((value.toordinal() - 1) * 24 + value.hour) * 60 +
+             value.minute) * 60 + value.second) * 10 ** 6 + value.microsecond
+        if offset is None:
+            return DATETIME_STRUCT.pack(microseconds)
+        return DATETIME_TZ_STRUCT.pack(microseconds, minutes)
+
+    def _unpack(self, value):
+        if len(value) == DATETIME_STRUCT.size:
+            microseconds, = DATETIME_STRUCT.unpack(value)
+            tzinfo = None
+        else:
+            microseconds, minutes = DATETIME_TZ_STRUCT.unpack(value)
+            microseconds += minutes * 60 * 10 ** 6
+            tzinfo = get_fixed_timezone(minutes)
+        days, microseconds = divmod(microseconds, MICROSECONDS_PER_DAY)
+        seconds, microsecond = divmod(microseconds, 10 ** 6)
+        minutes, second = divmod(seconds, 60)
+        hour, minute = divmod(minutes, 60)
+        date = datetime.date.fromordinal(days + 1)
+        return datetime.datetime(
+            date.year, date.month, date.day, hour, minute, second,
+            microsecond, tzinfo)
+
+
+# Packed number plaintexts (compact=True) start with a tag byte, while
+# numbers formatted as text start with a digit or a minus sign.
+INT_TAG = b'\x01'
+LONG_TAG = b'\x02'
+FLOAT_TAG = b'\x03'
+DECIMAL_TAG = b'\x04'
+# Tag and 64 bits signed integer.
+INT_STRUCT = struct.Struct('>cq')
+# Tag and IEEE-754 double.
+FLOAT_STRUCT = struct.Struct('>cd')
+# Tag, sign and exponent, followed by the coefficient.
+DECIMAL_STRUCT = struct.Struct('>cBi')
 
 
 class BaseEncryptedNumberField(BaseEncryptedField):
     # Do NOT define a __metaclass__ for this - it's abstract.
     # See BaseEncryptedDateField for full explanation.
+    max_packed_length = None
+    packed_tag = None
+
     def __init__(self, *args, **kwargs):
-        if self.max_raw_length:
+        self.compact = _pop_compact(kwargs)
+        if self.compact and self.packed_tag is None:
+            raise ValueError(
+                "%s has no compact encoding" % self.__class__.__name__)
+        if self.compact and self.max_packed_length:
+            kwargs['max_length'] = self.max_packed_length
+        elif self.max_raw_length:
             kwargs['max_length'] = self.max_raw_length
         super(BaseEncryptedNumberField, self).__init__(*args, **kwargs)
 
@@ -283,24 +1505,36 @@ class BaseEncryptedNumberField(BaseEncryptedField):
     def to_python(self, value):
         return self.from_db_value(value)
 
-    def from_db_value(self, value, expression, connection, context):
-        # value is either an int or a string of an integer
-        if isinstance(value, self.number_type) or value == '':
+    def _from_plaintext(self, value):
+        # value is either an int, packed bytes or a string of an integer
+        if value is None or isinstance(value, self.number_type) or value == '':
             number = value
+        elif self._is_packed(value):
+            number = self._unpack(value)
         else:
-            number_text = super(BaseEncryptedNumberField, self).from_db_value(
-                value, expression, connection, context)
-            number = self.number_type(number_text)
+            number = self.number_type(value)
         return number
 
-    # def get_prep_value(self, value):
-    def get_db_prep_value(self, value, connection=None, prepared=False):
-        number_text = self.format_string % value
-        return super(BaseEncryptedNumberField, self).get_db_prep_value(
-            number_text,
-            connection=connection,
-            prepared=prepared,
-        )
+    def _is_packed(self, value):
+        return (self.packed_tag is not None and isinstance(value, bytes) and
+                value[:1] == self.packed_tag)
+
+    def _decode_plaintext(self, value):
+        if self._is_packed(value):
+            return value
+        return force_unicode(value)
+
+    def _to_plaintext(self, value):
+        if self.compact:
+            return self._pack(value)
+        return self.format_string % value
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(
+            BaseEncryptedNumberField, self).deconstruct()
+        if self.compact:
+            kwargs['compact'] = True
+        return name, path, args, kwargs
 
 
 class EncryptedIntField(BaseEncryptedNumberField):
@@ -308,8 +1542,22 @@ class EncryptedIntField(BaseEncryptedNumberField):
         max_raw_length = len(str(-sys.maxsize - 1))
     else:
         max_raw_length = len(str(-sys.maxint - 1))
+    max_packed_length = INT_STRUCT.size
     number_type = int
     format_string = "%d"
+    packed_tag = INT_TAG
+
+    def _pack(self, value):
+        # Values are converted as format_string ("%d") does without
+        # compact=True, e.g. 3.7 is stored as 3.
+        try:
+            return INT_STRUCT.pack(INT_TAG, int(value))
+        except (OverflowError, struct.error):
+            raise ValueError(
+                "%r is out of the range of EncryptedIntField" % (value,))
+
+    def _unpack(self, value):
+        return INT_STRUCT.unpack(value)[1]
 
 
 class EncryptedLongField(BaseEncryptedNumberField):
@@ -319,35 +1567,201 @@ class EncryptedLongField(BaseEncryptedNumberField):
     else:
         number_type = long
     format_string = "%d"
+    # The tag is followed by the shortest two's complement of the value;
+    # its length is known from the padding.
+    packed_tag = LONG_TAG
 
     def get_internal_type(self):
         return 'TextField'
 
+    def _pack(self, value):
+        try:
+            return LONG_TAG + _int_to_bytes(self.number_type(value))
+        except OverflowError:
+            raise ValueError(
+                "%r can't be stored in EncryptedLongField" % (value,))
+
+    def _unpack(self, value):
+        return self.number_type(_int_from_bytes(value[1:]))
+
 
 class EncryptedFloatField(BaseEncryptedNumberField):
     max_raw_length = 150  # arbitrary, but should be sufficient
+    max_packed_length = FLOAT_STRUCT.size
     number_type = float
     # If this format is too long for some architectures, change it.
     format_string = "%0.66f"
+    # Packed floats are exact, text ones are rounded to 66 decimals.
+    packed_tag = FLOAT_TAG
+
+    def _pack(self, value):
+        return FLOAT_STRUCT.pack(FLOAT_TAG, value)
+
+    def _unpack(self, value):
+        return FLOAT_STRUCT.unpack(value)[1]
+
+
+class EncryptedDecimalField(BaseEncryptedNumberField):
+    max_raw_length = None  # no limit
+    number_type = decimal.Decimal
+    format_string = "%s"
+    packed_tag = DECIMAL_TAG
+
+    def get_internal_type(self):
+        return 'TextField'
+
+    def _to_plaintext(self, value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value))
+        return super(EncryptedDecimalField, self)._to_plaintext(value)
+
+    def _pack(self, value):
+        sign, digits, exponent = value.as_tuple()
+        if not isinstance(exponent, int):
+            raise ValueError(
+                "%s can't be stored with compact=True" % (value,))
+        coefficient = int(''.join(map(str, digits)))
+        try:
+            header = DECIMAL_STRUCT.pack(DECIMAL_TAG, sign, exponent)
+        except struct.error:
+            raise ValueError(
+                "The exponent of %s is out of the range of "
+                "EncryptedDecimalField with compact=True" % (value,))
+        return header + _int_to_bytes(coefficient)
+
+    def _unpack(self, value):
+        tag, sign, exponent = DECIMAL_STRUCT.unpack(value[:DECIMAL_STRUCT.size])
+        coefficient = _int_from_bytes(value[DECIMAL_STRUCT.size:])
+        return decimal.Decimal(
+            (sign, tuple(map(int, str(coefficient))), exponent))
+
+
+PICKLE_STORAGE_FORMATS = ('text', 'binary')
+
+# 'binary' PickleField values with out-of-band buffers (pickle protocol
+# 5) start with this byte, which no pickle starts with, followed by the
+# number of buffers, the lengths of the pickle and of every buffer, the
+# pickle and the buffers.
+PICKLE_BUFFERS_MAGIC = b'\x00'
+PICKLE_BUFFERS_COUNT = struct.Struct('>I')
+PICKLE_BUFFERS_LENGTH = struct.Struct('>Q')
 
 
 class PickleField(models.TextField):
+    '''Stores any picklable value.
+
+    By default values are stored as text, base64 encoded on Python 3.
+    With ``storage='binary'`` they are stored as raw bytes in a binary
+    column.  ``protocol`` is the pickle protocol (by default the default
+    protocol of ``pickle``); with protocol 5 and ``'binary'`` storage the
+    buffers of ``pickle.PickleBuffer`` objects and of NumPy arrays are
+    stored out-of-band, after the pickle, so loading arrays doesn't copy
+    them (such arrays are read-only).  Values of either
+    storage format are readable.'''
     editable = False
     serialize = False
 
+    def __init__(self, *args, **kwargs):
+        self.storage = kwargs.pop('storage', 'text')
+        if self.storage not in PICKLE_STORAGE_FORMATS:
+            raise ValueError(
+                "Unknown storage format %r, use one of: %s" % (
+                    self.storage, ', '.join(PICKLE_STORAGE_FORMATS)))
+        self.protocol = kwargs.pop('protocol', None)
+        if self.protocol is not None and not (
+                0 <= self.protocol <= pickle.HIGHEST_PROTOCOL):
+            raise ValueError(
+                "Pickle protocol %r is not supported, the highest one is "
+                "%d" % (self.protocol, pickle.HIGHEST_PROTOCOL))
+        # Pickles of protocol 2 and later start with b'\x80', which tells
+        # them apart from base64 text in binary columns.
+        if self.storage == 'binary' and (
+                self.protocol is not None and self.protocol < 2):
+            raise ValueError("'binary' storage requires pickle protocol 2+")
+        super(PickleField, self).__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        if self.storage == 'binary':
+            return models.BinaryField().db_type(connection)
+        return super(PickleField, self).db_type(connection)
+
+    def _dumps(self, value):
+        protocol = self.protocol
+        if protocol is None:
+            protocol = max(2, getattr(pickle, 'DEFAULT_PROTOCOL', 2))
+        if protocol < 5:
+            return pickle.dumps(value, protocol)
+        buffers = []
+        data = pickle.dumps(value, protocol, buffer_callback=buffers.append)
+        if not buffers:
+            return data
+        buffers = [buffer.raw() for buffer in buffers]
+        return b''.join(
+            [PICKLE_BUFFERS_MAGIC, PICKLE_BUFFERS_COUNT.pack(len(buffers)),
+             PICKLE_BUFFERS_LENGTH.pack(len(data))] +
+            [PICKLE_BUFFERS_LENGTH.pack(buffer.nbytes) for buffer in buffers] +
+            [data] + buffers)
+
+    def _dumps_text(self, value):
+        if self.protocol is None:
+            return pickle.dumps(value)
+        return pickle.dumps(value, self.protocol)
+
+    def _loads(self, data):
+        if data[:1] != PICKLE_BUFFERS_MAGIC:
+            return pickle.loads(data)
+        data = memoryview(data)
+        count, = PICKLE_BUFFERS_COUNT.unpack(data[1:1 + PICKLE_BUFFERS_COUNT.size])
+        offset = 1 + PICKLE_BUFFERS_COUNT.size
+        lengths = []
+        for index in range(count + 1):
+            lengths.append(PICKLE_BUFFERS_LENGTH.unpack(
+                data[offset:offset + PICKLE_BUFFERS_LENGTH.size])[0])
+            offset += PICKLE_BUFFERS_LENGTH.size
+        parts = []
+        for length in lengths:
+            parts.append(data[offset:offset + length])
+            offset += length
+        return pickle.loads(parts[0], buffers=parts[1:])
+
     def get_db_prep_value(self, value, connection=None, prepared=False):
+        start = metrics.timer() if metrics.enabled else None
+        if self.storage == 'binary':
+            val = self._dumps(value)
+            if start is not None:
+                metrics.record(self, 'pickle_dump', 1, len(val), start)
+            if connection is not None:
+                return connection.Database.Binary(val)
+            return val
         if PYTHON3 is True:
             # When PYTHON3, we convert data to base64 to prevent errors when
             # unpickling.
-            val = codecs.encode(pickle.dumps(value), 'base64').decode()
-            return val
+            val = codecs.encode(self._dumps_text(value), 'base64').decode()
         else:
-            return pickle.dumps(value)
+            val = self._dumps_text(value)
+        if start is not None:
+            metrics.record(self, 'pickle_dump', 1, len(val), start)
+        return val
 
     def to_python(self, value):
         return self.from_db_value(value)
 
     def from_db_value(self, value, expression, connection, context):
+        if (isinstance(value, BINARY_TYPES) and
+                not isinstance(value, string_types)):
+            # Values of binary columns: pickles, or base64 text written
+            # before the column was converted.
+            start = metrics.timer() if metrics.enabled else None
+            data = _to_bytes(value)
+            try:
+                if data[:1] not in (b'\x80', PICKLE_BUFFERS_MAGIC):
+                    data = codecs.decode(data, 'base64')
+                val = self._loads(data)
+            except (ValueError, EOFError, pickle.UnpicklingError):
+                return value
+            if start is not None:
+                metrics.record(self, 'pickle_load', 1, len(value), start)
+            return val
         if PYTHON3 is True:
             if not isinstance(value, str):
                 return value
@@ -357,20 +1771,31 @@ class PickleField(models.TextField):
 
         # Tries to convert unicode objects to string, cause loads pickle from
         # unicode excepts ugly ``KeyError: '\x00'``.
+        start = metrics.timer() if metrics.enabled else None
         try:
             if PYTHON3 is True:
                 # When PYTHON3, data are in base64 to prevent errors when
                 # unpickling.
                 val = pickle.loads(codecs.decode(value.encode(), "base64"))
-                return val
             else:
-                return pickle.loads(smart_str(value))
+                val = pickle.loads(smart_str(value))
         # If pickle could not loads from string it's means that it's Python
         # string saved to PickleField.
         except ValueError:
             return value
         except EOFError:
             return value
+        if start is not None:
+            metrics.record(self, 'pickle_load', 1, len(value), start)
+        return val
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(PickleField, self).deconstruct()
+        if self.storage != 'text':
+            kwargs['storage'] = self.storage
+        if self.protocol is not None:
+            kwargs['protocol'] = self.protocol
+        return name, path, args, kwargs
 
 
 class EncryptedUSPhoneNumberField(BaseEncryptedField):
@@ -429,9 +1854,16 @@ try:
             {
                 'cipher': ('cipher_type', {}),
                 'block_type': ('block_type', {}),
+                'padding': ('padding', {'default': 'printable'}),
+                'storage': ('storage', {'default': 'hex'}),
+                'blind_index': ('blind_index', {'default': False}),
+                'lazy': ('lazy', {'default': False}),
             },
         ),
     ], ["^django_fields\.fields\..+?Field"])
     add_introspection_rules([], ["^django_fields\.fields\.PickleField"])
+    add_introspection_rules([
+        ([BlindIndexField], [], {'source': ('source', {})}),
+    ], ["^django_fields\.fields\.BlindIndexField"])
 except ImportError:
     pass
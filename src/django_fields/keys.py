@@ -0,0 +1,76 @@
+"""Registry of versioned encryption keys.
+
+Keys are configured with the ``DJANGO_FIELDS_KEYS`` setting, mapping key
+ids (1 to 255) to secrets::
+
+    DJANGO_FIELDS_KEYS = {
+        1: 'the old secret',
+        2: 'the new secret',
+    }
+    DJANGO_FIELDS_ACTIVE_KEY_ID = 2  # by default the highest id
+
+Encrypted fields without an explicit ``secret_key`` encrypt with the
+active key and store its id with every value; values encrypted with any
+key of the registry stay readable.  Key id 0 stands for the key of the
+field itself (``secret_key``, by default ``settings.SECRET_KEY``), which
+is also used by fields with an explicit ``secret_key``, when no keys are
+configured, and for values written before keys were configured.
+
+Cipher keys are derived from the secrets (HMAC-SHA256 of the secret and
+the purpose), once per key and purpose.
+"""
+import hashlib
+import hmac
+import threading
+
+from django.conf import settings
+from django.utils.encoding import smart_bytes
+
+MAX_KEY_ID = 255
+
+
+class KeyRegistry(object):
+    def __init__(self, keys=None, active_key_id=None):
+        self.keys = dict(keys or {})
+        for key_id in self.keys:
+            if not 0 < key_id <= MAX_KEY_ID:
+                raise ValueError(
+                    "Key ids must be between 1 and %d, got %r" % (
+                        MAX_KEY_ID, key_id))
+        if active_key_id is None:
+            active_key_id = max(self.keys) if self.keys else 0
+        elif active_key_id not in self.keys:
+            raise ValueError("Unknown active key id %r" % active_key_id)
+        self.active_key_id = active_key_id
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key_id):
+        try:
+            return self.keys[key_id]
+        except KeyError:
+            raise ValueError("Unknown key id %r" % key_id)
+
+    def derive(self, key_id, purpose, length=32):
+        '''Returns the ``length`` bytes long subkey of key ``key_id`` for
+        ``purpose``, e.g. ``'cipher.AES'``.  Subkeys are computed once.'''
+        cache_key = (key_id, purpose, length)
+        subkey = self._derived.get(cache_key)
+        if subkey is None:
+            subkey = hmac.new(
+                smart_bytes(self.get(key_id)),
+                b'django_fields.' + smart_bytes(purpose),
+                hashlib.sha256,
+            ).digest()[:length]
+            with self._lock:
+                subkey = self._derived.setdefault(cache_key, subkey)
+        return subkey
+
+
+registry = KeyRegistry(
+    getattr(settings, 'DJANGO_FIELDS_KEYS', None),
+    getattr(settings, 'DJANGO_FIELDS_ACTIVE_KEY_ID', None),
+)
@@ -0,0 +1,52 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from django_fields.rotation import reencrypt
+
+
+class Command(BaseCommand):
+    help = ("Re-encrypts the values of the encrypted fields of a model which "
+            "were encrypted with another key than the active one of "
+            "DJANGO_FIELDS_KEYS, in primary key ordered batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='app_label.ModelName')
+        parser.add_argument(
+            '--fields', help='comma separated field names '
+                             '(default: all encrypted fields)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--rate-limit', type=float, default=None,
+            help='maximum number of rows per second')
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help='file for resuming an interrupted run')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--database', default=None)
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='only count the values to re-encrypt')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        fields = options['fields'].split(',') if options['fields'] else None
+        verbosity = options['verbosity']
+
+        def progress(stats):
+            if verbosity > 1:
+                self.stdout.write(str(stats))
+
+        try:
+            stats = reencrypt(
+                model, fields=fields, batch_size=options['batch_size'],
+                rate_limit=options['rate_limit'],
+                checkpoint=options['checkpoint'], workers=options['workers'],
+                using=options['database'], progress=progress,
+                dry_run=options['dry_run'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if verbosity > 0:
+            self.stdout.write('Done: %s' % stats)
@@ -0,0 +1,8 @@
+from .rotate_keys import Command as RotateKeysCommand
+
+
+class Command(RotateKeysCommand):
+    help = ("Re-encrypts the values of the encrypted fields of a model which "
+            "were written with another block type (e.g. the legacy ECB "
+            "default), storage format or key than the fields use now, in "
+            "primary key ordered batches. Use --dry-run to count them.")
@@ -0,0 +1,134 @@
+"""Instrumentation of the encryption, decryption and pickling done by the
+fields of django_fields.
+
+Every operation is reported to the registered callbacks as::
+
+    callback(field, operation, count, size, duration)
+
+where ``operation`` is one of ``OPERATIONS``, ``count`` the number of
+values, ``size`` the number of stored (encrypted or pickled) bytes and
+``duration`` the time taken in seconds.  Batch operations such as
+``encrypt_many`` are reported once for the whole batch.  While nothing is
+registered, fields only check the ``enabled`` flag.
+
+``collect()`` sums up the operations of the current thread, e.g. for a
+single request::
+
+    with metrics.collect() as summary:
+        response = view(request)
+    logger.info('crypto: %s', summary)
+
+Operations run in other processes (see ``django_fields.parallel``) are not
+reported.
+"""
+import threading
+from timeit import default_timer as timer
+
+OPERATIONS = ('encrypt', 'decrypt', 'pickle_dump', 'pickle_load')
+
+enabled = False
+
+_callbacks = []
+_collectors = 0
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def _update():
+    global enabled
+    enabled = bool(_callbacks) or _collectors > 0
+
+
+def register(callback):
+    '''Reports all operations, of every thread, to ``callback``.'''
+    with _lock:
+        _callbacks.append(callback)
+        _update()
+
+
+def unregister(callback):
+    with _lock:
+        _callbacks.remove(callback)
+        _update()
+
+
+def field_label(field):
+    '''Returns "Model.field" for fields of models, or the class name.'''
+    model = getattr(field, 'model', None)
+    if model is None or not getattr(field, 'name', None):
+        return field.__class__.__name__
+    return '%s.%s' % (model.__name__, field.name)
+
+
+def record(field, operation, count, size, start):
+    '''Reports an operation started at ``start`` (a ``timer()`` value).'''
+    duration = timer() - start
+    for callback in _callbacks:
+        callback(field, operation, count, size, duration)
+    for collector in getattr(_local, 'collectors', ()):
+        collector(field, operation, count, size, duration)
+
+
+class Stats(object):
+    __slots__ = ('count', 'size', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.duration = 0.0
+
+    def __repr__(self):
+        return 'Stats(count=%d, size=%d, duration=%.6f)' % (
+            self.count, self.size, self.duration)
+
+
+class collect(object):
+    '''Context manager summing up the operations of the current thread.
+
+    ``stats`` maps (field label, operation) to ``Stats``; ``totals()``
+    sums them up per operation.'''
+
+    def __init__(self):
+        self.stats = {}
+
+    def __call__(self, field, operation, count, size, duration):
+        key = (field_label(field), operation)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = Stats()
+        stats.count += count
+        stats.size += size
+        stats.duration += duration
+
+    def totals(self):
+        totals = {}
+        for (label, operation), stats in self.stats.items():
+            total = totals.setdefault(operation, Stats())
+            total.count += stats.count
+            total.size += stats.size
+            total.duration += stats.duration
+        return totals
+
+    def __str__(self):
+        return ', '.join(
+            '%s: %d values, %d bytes, %.2f ms' % (
+                operation, stats.count, stats.size, stats.duration * 1000)
+            for operation, stats in sorted(self.totals().items()))
+
+    def __enter__(self):
+        global _collectors
+        collectors = getattr(_local, 'collectors', None)
+        if collectors is None:
+            collectors = _local.collectors = []
+        collectors.append(self)
+        with _lock:
+            _collectors += 1
+            _update()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _collectors
+        _local.collectors.remove(self)
+        with _lock:
+            _collectors -= 1
+            _update()
@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import sys
+import threading
 
-from django.db import models
+import django
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, models
+from django.db.models import ExpressionWrapper, F
+from django.db.models.query import ModelIterable
+
+from .fields import BaseEncryptedField, StoredValue
+from . import parallel
 
 if sys.version_info[0] == 3:
     PYTHON3 = True
@@ -10,6 +19,109 @@ else:
     PYTHON3 = False
 
 
+class BackgroundCall(object):
+    """Runs ``func(*args)`` in a separate thread; ``result()`` waits
+    for it and returns its result or re-raises its exception."""
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            if PYTHON3 is True:
+                raise self._error[1].with_traceback(self._error[2])
+            raise self._error[1]
+        return self._result
+
+
+def raw_column(field):
+    """Returns an expression selecting the stored (still encrypted) value
+    of ``field``: the column is selected through ``F()``, so joins of
+    inherited fields are set up, but with a plain output field, whose
+    converters don't decrypt."""
+    if field.storage == 'binary':
+        output_field = models.BinaryField()
+    else:
+        output_field = models.TextField()
+    return ExpressionWrapper(F(field.name), output_field=output_field)
+
+
+def decrypt_columns(chunk, encrypted_fields, connection=None):
+    """Decrypts the raw encrypted columns of a chunk of rows from
+    ``EncryptedQuerySet._raw_values``; returns a dict of lists."""
+    return dict(
+        (alias, field.from_db_values([row[alias] for row in chunk], connection))
+        for name, alias, field in encrypted_fields
+    )
+
+
+def build_rows(chunk, columns, fields, select_names, encrypted_fields, as_dict):
+    """Turns a chunk of rows from ``EncryptedQuerySet._raw_values`` and
+    their decrypted ``columns`` into dicts or tuples of ``fields``."""
+    result = []
+    for index, row in enumerate(chunk):
+        for name, alias, field in encrypted_fields:
+            row[alias] = columns[alias][index]
+        values = [row[select_name] for select_name in select_names]
+        if as_dict:
+            result.append(dict(zip(fields, values)))
+        else:
+            result.append(tuple(values))
+    return result
+
+
+class _ExecutorJob(object):
+    """Decrypts the encrypted columns of a chunk of rows on an executor."""
+    def __init__(self, executor, chunk, encrypted_fields, build):
+        self.chunk = chunk
+        self.build = build
+        self.futures = [
+            (alias, parallel.submit(
+                executor, 'decrypt', field, [row[alias] for row in chunk]))
+            for name, alias, field in encrypted_fields
+        ]
+
+    def result(self):
+        return self.build(self.chunk, dict(
+            (alias, future.result()) for alias, future in self.futures))
+
+
+class LazyModelIterable(ModelIterable):
+    """Yields model instances whose encrypted fields with ``lazy=True``
+    hold their stored values (as ``StoredValue`` objects), which
+    ``LazyDecryptionDescriptor`` decrypts on first access.  Other
+    querysets (``values()``, plain managers) decrypt these fields like
+    any other."""
+    def __iter__(self):
+        queryset = self.queryset
+        lazy_fields = queryset._lazy_fields()
+        if lazy_fields:
+            queryset = queryset.defer(
+                *[field.name for field in lazy_fields]
+            ).annotate(**dict(
+                ('_raw_' + field.attname, raw_column(field))
+                for field in lazy_fields
+            ))
+        iterable = ModelIterable(queryset, chunked_fetch=self.chunked_fetch)
+        if hasattr(self, 'chunk_size'):
+            iterable.chunk_size = self.chunk_size
+        for obj in iterable:
+            for field in lazy_fields:
+                obj.__dict__[field.attname] = StoredValue(
+                    obj.__dict__.pop('_raw_' + field.attname))
+            yield obj
+
+
 class PrivateFieldsMetaclass(models.base.ModelBase):
     """Metaclass to set right default db_column values
     for mangled private fields.
@@ -35,3 +147,245 @@ class PrivateFieldsMetaclass(models.base.ModelBase):
         result = super_new(cls, name, bases, attrs)
         return result
 
+
+
+class EncryptedQuerySet(models.QuerySet):
+    """QuerySet with helpers for models with encrypted fields.
+
+    Usage::
+
+        class Customer(models.Model):
+            email = EncryptedEmailField(block_type='MODE_CBC')
+
+            objects = EncryptedManager()
+
+        for customer in Customer.objects.filter(...).bulk_decrypt():
+            ...
+
+    Model instances loaded through it keep the stored values of fields
+    with ``lazy=True`` until they are accessed (see ``LazyModelIterable``).
+    """
+    def __init__(self, *args, **kwargs):
+        super(EncryptedQuerySet, self).__init__(*args, **kwargs)
+        self._iterable_class = LazyModelIterable
+
+    def _encrypted_fields(self):
+        return [
+            field for field in self.model._meta.concrete_fields
+            if isinstance(field, BaseEncryptedField)
+        ]
+
+    def _lazy_fields(self):
+        """Returns the encrypted fields with ``lazy=True`` which this
+        queryset loads (those not deferred)."""
+        if getattr(self.query, 'combinator', None):
+            return []
+        names, defer = self.query.deferred_loading
+        return [
+            field for field in self._encrypted_fields()
+            if field.lazy and (field.name in names) != defer
+        ]
+
+    def bulk_decrypt(self, chunk_size=1000):
+        """Iterates over model instances, decrypting encrypted columns in
+        chunks of ``chunk_size`` rows instead of one value at a time.
+
+        Encrypted columns are fetched raw (bypassing ``from_db_value``)
+        and every column of a chunk is decrypted with a single
+        ``BaseEncryptedField.from_db_values`` call.
+        """
+        encrypted_fields = self._encrypted_fields()
+        if not encrypted_fields:
+            for obj in self.iterator():
+                yield obj
+            return
+
+        connection = connections[self.db]
+        raw_columns = dict(
+            ('_raw_' + field.attname, raw_column(field))
+            for field in encrypted_fields
+        )
+        queryset = self.defer(
+            *[field.name for field in encrypted_fields]
+        ).annotate(**raw_columns)
+
+        chunk = []
+        for obj in queryset.iterator():
+            chunk.append(obj)
+            if len(chunk) >= chunk_size:
+                for decrypted in self._decrypt_chunk(
+                        chunk, encrypted_fields, connection):
+                    yield decrypted
+                chunk = []
+        for obj in self._decrypt_chunk(chunk, encrypted_fields, connection):
+            yield obj
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """Encrypts the values of every encrypted field for all ``objs``
+        with a single ``BaseEncryptedField.encrypt_many`` call per field
+        before inserting them.
+
+        The objects keep their plaintext values afterwards.
+        """
+        objs = list(objs)
+        connection = connections[self.db]
+        plaintexts = []
+        try:
+            for field in self._encrypted_fields():
+                values = [getattr(obj, field.attname) for obj in objs]
+                plaintexts.append((field, values))
+                if field.blind_index:
+                    for obj, value in zip(objs, values):
+                        if not field._is_encrypted(value):
+                            setattr(obj, field.blind_index_name,
+                                    field.blind_index_digest(value))
+                encrypted = field.encrypt_many(values, connection)
+                for obj, value in zip(objs, encrypted):
+                    setattr(obj, field.attname, value)
+            return super(EncryptedQuerySet, self).bulk_create(
+                objs, *args, **kwargs)
+        finally:
+            for field, values in plaintexts:
+                for obj, value in zip(objs, values):
+                    setattr(obj, field.attname, value)
+
+    def update(self, **kwargs):
+        """Updates blind indexes along with their encrypted fields.
+
+        Callers which set the index themselves (such as ``bulk_update``)
+        may pass expressions for fields with a blind index."""
+        for field in self._encrypted_fields():
+            if (field.blind_index and field.name in kwargs and
+                    field.blind_index_name not in kwargs):
+                kwargs[field.blind_index_name] = field.blind_index_digest(
+                    kwargs[field.name])
+        return super(EncryptedQuerySet, self).update(**kwargs)
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        """Updates blind indexes along with their encrypted fields."""
+        objs = list(objs)
+        fields = list(fields)
+        for field in self._encrypted_fields():
+            if not field.blind_index or field.name not in fields:
+                continue
+            for obj in objs:
+                value = getattr(obj, field.attname)
+                if not field._is_encrypted(value):
+                    setattr(obj, field.blind_index_name,
+                            field.blind_index_digest(value))
+            if field.blind_index_name not in fields:
+                fields.append(field.blind_index_name)
+        return super(EncryptedQuerySet, self).bulk_update(
+            objs, fields, *args, **kwargs)
+    bulk_update.alters_data = True
+
+    def stream_values(self, *fields, **kwargs):
+        """Like ``values()``, but yields dicts with decrypted values while
+        keeping at most a few chunks of rows in memory.
+
+        Rows are fetched with ``iterator()`` in chunks of ``chunk_size``
+        (keyword argument, default 2000).  Each chunk is decrypted in a
+        background thread while the next one is being fetched.
+
+        With an ``executor`` (``concurrent.futures`` executor, see
+        ``django_fields.parallel.get_executor``) chunks are decrypted by
+        its workers instead, up to ``max_pending`` (default 8) chunks at a
+        time; rows are still yielded in order.
+        """
+        return self._stream(fields, True, **kwargs)
+
+    def stream_values_list(self, *fields, **kwargs):
+        """Like ``stream_values()``, but yields tuples."""
+        return self._stream(fields, False, **kwargs)
+
+    def values_array(self, field_name):
+        """Returns the values of the encrypted number field ``field_name``
+        as a NumPy array; see ``django_fields.arrays.decrypt_array``."""
+        from .arrays import decrypt_array
+        fields, queryset, select_names, encrypted_fields = self._raw_values(
+            [field_name])
+        if not encrypted_fields:
+            raise ValueError("%s is not an encrypted field" % field_name)
+        name, alias, field = encrypted_fields[0]
+        return decrypt_array(field, [row[alias] for row in queryset])
+
+    def _raw_values(self, fields):
+        """Returns ``(fields, queryset, select_names, encrypted_fields)``
+        where ``queryset`` is a ``values()`` queryset for ``fields`` (by
+        default all concrete fields) which selects encrypted columns
+        without decrypting them, under the ``select_names`` aliases.
+        ``encrypted_fields`` lists ``(name, alias, field)`` triples."""
+        if not fields:
+            fields = [field.attname for field in self.model._meta.concrete_fields]
+
+        select_names = []
+        raw_columns = {}
+        encrypted_fields = []
+        for name in fields:
+            try:
+                field = self.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                field = None
+            if isinstance(field, BaseEncryptedField):
+                alias = '_raw_' + field.attname
+                raw_columns[alias] = raw_column(field)
+                encrypted_fields.append((name, alias, field))
+                select_names.append(alias)
+            else:
+                select_names.append(name)
+
+        queryset = self.annotate(**raw_columns).values(*select_names)
+        return fields, queryset, select_names, encrypted_fields
+
+    def _stream(self, fields, as_dict, chunk_size=2000, executor=None,
+                max_pending=8):
+        fields, queryset, select_names, encrypted_fields = self._raw_values(fields)
+        connection = connections[self.db]
+        if django.VERSION >= (2, 0):
+            rows = queryset.iterator(chunk_size=chunk_size)
+        else:
+            rows = queryset.iterator()
+
+        def build(chunk, columns):
+            return build_rows(
+                chunk, columns, fields, select_names, encrypted_fields, as_dict)
+
+        def decrypt(chunk):
+            return build(chunk, decrypt_columns(chunk, encrypted_fields, connection))
+
+        if executor is None:
+            start = lambda chunk: BackgroundCall(decrypt, chunk)
+            max_pending = 1
+        else:
+            start = lambda chunk: _ExecutorJob(
+                executor, chunk, encrypted_fields, build)
+
+        pending = collections.deque()
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                pending.append(start(chunk))
+                chunk = []
+                if len(pending) > max_pending:
+                    for result in pending.popleft().result():
+                        yield result
+        if chunk:
+            pending.append(start(chunk))
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+
+    def _decrypt_chunk(self, chunk, encrypted_fields, connection):
+        for field in encrypted_fields:
+            raw_name = '_raw_' + field.attname
+            values = field.from_db_values(
+                [obj.__dict__.pop(raw_name) for obj in chunk], connection)
+            for obj, value in zip(chunk, values):
+                setattr(obj, field.attname, value)
+        return chunk
+
+
+class EncryptedManager(models.Manager.from_queryset(EncryptedQuerySet)):
+    pass
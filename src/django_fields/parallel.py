@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Encryption and decryption of large batches of values on several cores.
+
+Requires ``concurrent.futures`` (the ``futures`` package on Python 2).
+
+Usage::
+
+    from django_fields.parallel import decrypt_parallel
+
+    field = Customer._meta.get_field('email')
+    emails = decrypt_parallel(field, raw_values, max_workers=16)
+
+"""
+from importlib import import_module
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Fields rebuilt from their spec in worker processes, see _get_field().
+_fields = {}
+
+
+def field_spec(field):
+    """Returns a picklable description from which worker processes
+    rebuild ``field`` (an encrypted field, see ``_get_field``), including
+    the id of the key it encrypts with."""
+    name, path, args, kwargs = field.deconstruct()
+    kwargs['secret_key'] = field.secret_key
+    for key in ('blind_index', 'lazy', 'cache'):
+        kwargs.pop(key, None)
+    return path, tuple(args), tuple(sorted(kwargs.items())), field.key_id
+
+
+def _get_field(spec):
+    field = _fields.get(spec)
+    if field is None:
+        path, args, kwargs, key_id = spec
+        module_name, class_name = path.rsplit('.', 1)
+        field_class = getattr(import_module(module_name), class_name)
+        field = field_class(*args, **dict(kwargs))
+        # An explicit secret_key selects key id 0.
+        field._use_key(key_id)
+        _fields[spec] = field
+    return field
+
+
+def _run(operation, spec, values):
+    field = _get_field(spec)
+    if operation == 'decrypt':
+        return field.from_db_values(values)
+    return field.encrypt_many(values)
+
+
+def get_executor(field, max_workers=None):
+    """Returns an executor suited for ``field``: a thread pool if its
+    cipher releases the GIL, a process pool otherwise."""
+    if futures is None:
+        raise ImportError(
+            "Parallel encryption requires concurrent.futures; install the "
+            "'futures' package on Python 2.")
+    if field.cipher_factory.releases_gil:
+        return futures.ThreadPoolExecutor(max_workers=max_workers or 4)
+    return futures.ProcessPoolExecutor(max_workers=max_workers)
+
+
+def submit(executor, operation, field, values):
+    """Schedules the decryption (``operation='decrypt'``, giving python
+    values) or encryption (``'encrypt'``) of ``values`` on ``executor``
+    and returns the future."""
+    return executor.submit(_run, operation, field_spec(field), list(values))
+
+
+def _map(operation, field, values, executor, chunk_size, max_workers):
+    values = list(values)
+    own_executor = executor is None
+    if own_executor:
+        executor = get_executor(field, max_workers)
+    try:
+        jobs = [
+            submit(executor, operation, field, values[start:start + chunk_size])
+            for start in range(0, len(values), chunk_size)
+        ]
+        result = []
+        for job in jobs:
+            result.extend(job.result())
+        return result
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def decrypt_parallel(field, values, executor=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE, max_workers=None):
+    """Decrypts stored ``values`` of ``field`` into python values, in
+    chunks of ``chunk_size`` spread over ``executor`` (by default a pool
+    from ``get_executor``).  The result keeps the order of ``values``."""
+    return _map('decrypt', field, values, executor, chunk_size, max_workers)
+
+
+def encrypt_parallel(field, values, executor=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE, max_workers=None):
+    """Encrypts python ``values`` of ``field`` for storing; the parallel
+    counterpart of ``field.encrypt_many``."""
+    return _map('encrypt', field, values, executor, chunk_size, max_workers)
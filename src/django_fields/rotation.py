@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Online re-encryption of the encrypted columns of a model, after a new
+key became the active one of the key registry (see django_fields.keys),
+or to upgrade values written with another block type (such as the
+legacy ECB default) or storage format than the field uses now::
+
+    from django_fields.rotation import reencrypt
+
+    stats = reencrypt(Customer, batch_size=1000, rate_limit=5000,
+                      checkpoint='/var/tmp/customer-rotation.json')
+
+or ``manage.py rotate_keys app_label.Customer`` (``upgrade_encryption``
+does the same).  With ``dry_run=True`` (``--dry-run``) values are only
+counted.
+
+Rows are processed in primary key order, in batches of ``batch_size``
+rows.  Every batch is read with ``select_for_update()`` and written with
+``bulk_update()`` in one transaction, so rows written concurrently by the
+application are never overwritten with stale values.  Only values for
+which ``field.needs_reencryption()`` is true are written.  Fields keep
+reading values of every registered key, so the application keeps working
+while the job runs; values of another block type are read by the job
+only, unless the fields have ``accept_legacy=True``.
+
+With a ``checkpoint`` file an interrupted job resumes where it stopped;
+the file is removed once the job completes.  With
+``workers > 1`` (integer primary keys only) the primary key range is
+split between that many threads, each with its own database connection;
+this needs a database which allows concurrent writers (not SQLite).
+"""
+import copy
+import json
+import numbers
+import os
+import threading
+import time
+
+from django.db import connections, models, transaction
+
+from .fields import BaseEncryptedField
+from .models import EncryptedQuerySet
+
+
+class ReencryptionStats(object):
+    """Progress of a re-encryption job."""
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.rows = 0
+        self.values = 0
+        self.batches = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed else 0.0
+
+    @property
+    def values_per_second(self):
+        elapsed = self.elapsed
+        return self.values / elapsed if elapsed else 0.0
+
+    def add_batch(self, rows, values, progress=None):
+        with self._lock:
+            self.rows += rows
+            self.values += values
+            self.batches += 1
+            if progress is not None:
+                progress(self)
+
+    def __str__(self):
+        return '%d rows, %d values %s, %.1f rows/s, %.1f values/s' % (
+            self.rows, self.values,
+            'to re-encrypt' if self.dry_run else 're-encrypted',
+            self.rows_per_second, self.values_per_second)
+
+
+class Checkpoint(object):
+    """JSON file with the primary key ranges of a job and the last
+    primary key processed in each of them."""
+    def __init__(self, path, label):
+        self.path = path
+        self.label = label
+        self.ranges = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get('model') != self.label:
+            raise ValueError(
+                "Checkpoint %s belongs to %s, not to %s" % (
+                    self.path, data.get('model'), self.label))
+        return data['ranges']
+
+    def save(self, index=None, last_pk=None):
+        with self._lock:
+            if index is not None:
+                self.ranges[index][2] = last_pk
+            if self.path is None:
+                return
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({'model': self.label, 'ranges': self.ranges}, f)
+            os.rename(temporary, self.path)
+
+    def delete(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _split_range(queryset, workers):
+    """Returns ``workers`` [start, end, None] ranges (start exclusive,
+    end inclusive, ``None`` meaning unbounded) of the primary keys."""
+    if workers == 1:
+        return [[None, None, None]]
+    bounds = queryset.aggregate(low=models.Min('pk'), high=models.Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    if low is None:
+        return [[None, None, None]]
+    if not isinstance(low, numbers.Integral):
+        raise ValueError("Parallel workers require integer primary keys")
+    step = max((high - low + 1) // workers, 1)
+    starts = [None] + [low - 1 + step * index for index in range(1, workers)]
+    ends = starts[1:] + [None]
+    return [[start, end, None] for start, end in zip(starts, ends)]
+
+
+def _legacy_reader(field):
+    """Returns a copy of ``field`` which also decrypts values of other
+    block types than its own."""
+    reader = copy.copy(field)
+    reader.accept_legacy = True
+    return reader
+
+
+def _count_batch(queryset, encrypted_fields, pk_name, batch_size):
+    rows = list(queryset.order_by('pk')[:batch_size])
+    if not rows:
+        return 0, 0, None
+    values = sum(
+        1 for name, alias, field in encrypted_fields for row in rows
+        if field.needs_reencryption(row[alias]))
+    return len(rows), values, rows[-1][pk_name]
+
+
+def _process_batch(model, fields, using, start, end, batch_size,
+                   dry_run=False):
+    """Re-encrypts the stale values of the next ``batch_size`` rows after
+    primary key ``start`` (or only counts them, with ``dry_run``);
+    returns (rows, values, last primary key)."""
+    connection = connections[using]
+    pk_name = model._meta.pk.attname
+    queryset = EncryptedQuerySet(model=model, using=using)
+    if start is not None:
+        queryset = queryset.filter(pk__gt=start)
+    if end is not None:
+        queryset = queryset.filter(pk__lte=end)
+    names, queryset, select_names, encrypted_fields = queryset._raw_values(
+        [pk_name] + [field.name for field in fields])
+    if dry_run:
+        return _count_batch(queryset, encrypted_fields, pk_name, batch_size)
+
+    with transaction.atomic(using=using):
+        rows = list(queryset.order_by('pk').select_for_update()[:batch_size])
+        if not rows:
+            return 0, 0, None
+        objs = {}
+        for name, alias, field in encrypted_fields:
+            stale = [row for row in rows if field.needs_reencryption(row[alias])]
+            if not stale:
+                continue
+            values = _legacy_reader(field).from_db_values(
+                [row[alias] for row in stale], connection)
+            encrypted = field.encrypt_many(values, connection)
+            for row, value in zip(stale, encrypted):
+                obj = objs.get(row[pk_name])
+                if obj is None:
+                    obj = objs[row[pk_name]] = (model(pk=row[pk_name]), set())
+                obj[0].__dict__[field.attname] = value
+                obj[1].add(field.attname)
+
+        updated = 0
+        plain_queryset = models.QuerySet(model=model, using=using)
+        if hasattr(plain_queryset, 'bulk_update'):
+            by_fields = {}
+            for obj, attnames in objs.values():
+                by_fields.setdefault(tuple(sorted(attnames)), []).append(obj)
+            for attnames, group in by_fields.items():
+                plain_queryset.bulk_update(group, attnames)
+                updated += len(group) * len(attnames)
+        else:
+            for obj, attnames in objs.values():
+                plain_queryset.filter(pk=obj.pk).update(**dict(
+                    (attname, obj.__dict__[attname]) for attname in attnames))
+                updated += len(attnames)
+    return len(rows), updated, rows[-1][pk_name]
+
+
+def _process_range(model, fields, using, checkpoint, index, batch_size,
+                   rate_limit, stats, progress, dry_run):
+    start, end, last_pk = checkpoint.ranges[index]
+    if last_pk is not None:
+        start = last_pk
+    while True:
+        batch_started = time.time()
+        rows, values, last_pk = _process_batch(
+            model, fields, using, start, end, batch_size, dry_run)
+        if not rows:
+            break
+        start = last_pk
+        checkpoint.save(index, last_pk)
+        stats.add_batch(rows, values, progress)
+        if rate_limit:
+            delay = float(rows) / rate_limit - (time.time() - batch_started)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def reencrypt(model, fields=None, batch_size=1000, rate_limit=None,
+              checkpoint=None, workers=1, using=None, progress=None,
+              dry_run=False):
+    """Re-encrypts the values of the encrypted ``fields`` (names, by
+    default all encrypted fields) of ``model`` which are not encrypted
+    with the active key, the field's block type or storage format.
+
+    ``rate_limit`` caps the rows processed per second (over all
+    workers), ``checkpoint`` is the path of a JSON file for resuming and
+    ``progress`` a callable receiving the ``ReencryptionStats`` after
+    every batch.  With ``dry_run`` values are counted but not written
+    (and no checkpoint is kept).  Returns the ``ReencryptionStats`` of
+    the job."""
+    using = using or models.QuerySet(model=model).db
+    if fields is None:
+        fields = [
+            field for field in model._meta.concrete_fields
+            if isinstance(field, BaseEncryptedField)
+        ]
+    else:
+        fields = [model._meta.get_field(name) for name in fields]
+
+    job = Checkpoint(None if dry_run else checkpoint, '%s.%s' % (
+        model._meta.app_label, model._meta.model_name))
+    job.ranges = job.load()
+    if job.ranges is None:
+        job.ranges = _split_range(
+            models.QuerySet(model=model, using=using), workers)
+        job.save()
+
+    stats = ReencryptionStats(dry_run)
+    if rate_limit:
+        rate_limit = float(rate_limit) / len(job.ranges)
+    arguments = [
+        (model, fields, using, job, index, batch_size, rate_limit, stats,
+         progress, dry_run)
+        for index in range(len(job.ranges))
+    ]
+    if len(arguments) == 1:
+        _process_range(*arguments[0])
+    else:
+        errors = []
+
+        def run(args):
+            try:
+                _process_range(*args)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections[using].close()
+
+        threads = [threading.Thread(target=run, args=(args,))
+                   for args in arguments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+    job.delete()
+    return stats
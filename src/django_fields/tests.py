@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import binascii
+import codecs
 import datetime
+import decimal
+import pickle
 import re
 import string
 import sys
+import threading
 import unittest
 
 import django
@@ -14,10 +19,14 @@ from django.db import models
 from .fields import (
     EncryptedCharField, EncryptedDateField,
     EncryptedDateTimeField, EncryptedIntField,
-    EncryptedLongField, EncryptedFloatField, PickleField,
+    EncryptedLongField, EncryptedFloatField, EncryptedDecimalField,
+    PickleField,
     EncryptedUSPhoneNumberField, EncryptedUSSocialSecurityNumberField,
-    EncryptedEmailField,
+    EncryptedEmailField, EncryptedTextField,
 )
+from .fields import CipherFactory, decryption_cache
+from .models import EncryptedManager
+from . import arrays, backends, keys, metrics, parallel, rotation
 
 if django.VERSION[1] > 9:
     DJANGO_1_10 = True
@@ -67,6 +76,21 @@ class EncLong(models.Model):
         app_label = 'django_fields'
 
 
+class CompactNumberObject(models.Model):
+    int_number = EncryptedIntField(block_type='MODE_CBC', compact=True)
+    long_number = EncryptedLongField(
+        block_type='MODE_CBC', compact=True, null=True)
+    float_number = EncryptedFloatField(
+        block_type='MODE_CBC', compact=True, null=True)
+    decimal_number = EncryptedDecimalField(
+        block_type='MODE_CBC', compact=True, null=True)
+
+    objects = EncryptedManager()
+
+    class Meta:
+        app_label = 'django_fields'
+
+
 class EncFloat(models.Model):
     important_number = EncryptedFloatField()
 
@@ -74,6 +98,13 @@ class EncFloat(models.Model):
         app_label = 'django_fields'
 
 
+class EncDecimal(models.Model):
+    important_number = EncryptedDecimalField()
+
+    class Meta:
+        app_label = 'django_fields'
+
+
 class PickleObject(models.Model):
     name = models.CharField(max_length=16)
     data = PickleField()
@@ -82,6 +113,15 @@ class PickleObject(models.Model):
         app_label = 'django_fields'
 
 
+class BinaryPickleObject(models.Model):
+    data = PickleField(storage='binary', null=True)
+    buffers = PickleField(
+        storage='binary', protocol=pickle.HIGHEST_PROTOCOL, null=True)
+
+    class Meta:
+        app_label = 'django_fields'
+
+
 class EmailObject(models.Model):
     max_email = 255
     email = EncryptedEmailField(max_length=max_email)
@@ -121,6 +161,96 @@ class CipherEncDate(models.Model):
         app_label = 'django_fields'
 
 
+class InheritedParent(models.Model):
+    secret = EncryptedCharField(max_length=20, block_type='MODE_CBC')
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class InheritedChild(InheritedParent):
+    note = EncryptedTextField(block_type='MODE_CBC')
+
+    objects = EncryptedManager()
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class CompactDateObject(models.Model):
+    important_date = EncryptedDateField(block_type='MODE_CBC', compact=True)
+    important_datetime = EncryptedDateTimeField(
+        block_type='MODE_CBC', compact=True, null=True)
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class BulkEncObject(models.Model):
+    password = EncryptedCharField(max_length=20, null=True)
+    cipher_password = EncryptedCharField(
+        max_length=20, null=True, block_type='MODE_CBC')
+    important_date = EncryptedDateField(block_type='MODE_CBC')
+
+    objects = EncryptedManager()
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class CompactEncObject(models.Model):
+    max_password = 20
+    password = EncryptedCharField(
+        max_length=max_password, null=True,
+        block_type='MODE_CBC', storage='binary')
+    text = EncryptedTextField(
+        max_length=1000, block_type='MODE_CBC', storage='base64')
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class BlindIndexObject(models.Model):
+    email = EncryptedEmailField(
+        max_length=255, null=True, block_type='MODE_CBC', blind_index=True)
+
+    objects = EncryptedManager()
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class LazyEncObject(models.Model):
+    password = EncryptedCharField(
+        max_length=20, null=True, block_type='MODE_CBC', lazy=True)
+    important_date = EncryptedDateField(block_type='MODE_CBC', lazy=True)
+
+    objects = EncryptedManager()
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class AEADEncObject(models.Model):
+    max_password = 20
+    password = EncryptedCharField(
+        max_length=max_password, null=True, block_type='MODE_GCM',
+        storage='binary')
+    text = EncryptedTextField(block_type='MODE_CHACHA20_POLY1305')
+    important_date = EncryptedDateField(block_type='MODE_GCM')
+
+    class Meta:
+        app_label = 'django_fields'
+
+
+class RotationObject(models.Model):
+    secret = EncryptedCharField(max_length=20, null=True, block_type='MODE_CBC')
+    note = EncryptedTextField(block_type='MODE_GCM', storage='base64')
+
+    class Meta:
+        app_label = 'django_fields'
+
+
 class EncryptTests(unittest.TestCase):
 
     def setUp(self):
@@ -157,6 +287,19 @@ class EncryptTests(unittest.TestCase):
         self.assertNotEqual(encrypted_password, password)
         self.assertTrue(encrypted_password.startswith('$AES$MODE_CBC$'))
 
+    def test_fresh_iv_per_value(self):
+        """
+        Every value encrypted with a block type gets its own IV.
+        """
+        field = CipherEncObject._meta.get_field('password')
+        prefix_length = len(field.prefix)
+        iv_length = field.block_size * 2
+        ivs = set(
+            field.get_db_prep_value('password')[prefix_length:prefix_length + iv_length]
+            for index in range(50)
+        )
+        self.assertEqual(len(ivs), 50)
+
     def test_multiple_encryption_w_cipher(self):
         """
         Test that a single field can be reused without error.
@@ -213,6 +356,26 @@ class EncryptTests(unittest.TestCase):
             password = 'a' * pwd_length  # 'a', 'aa', ...
             self.assertTrue(enc_field._get_padding(password) >= 2)
 
+    def test_padding_schemes(self):
+        """
+        Values padded with either scheme can be read by both.
+        """
+        printable = EncryptedCharField(max_length=40, block_type='MODE_CBC')
+        pkcs7 = EncryptedCharField(
+            max_length=40, block_type='MODE_CBC', padding='pkcs7')
+        passwords = ['a' * pwd_length for pwd_length in range(0, 41)]
+        passwords.append(u'совершенно секретно')
+        for password in passwords:
+            for writer in (printable, pkcs7):
+                encrypted = writer.get_db_prep_value(password)
+                for reader in (printable, pkcs7):
+                    self.assertEqual(
+                        password,
+                        reader.from_db_value(encrypted, None, None, None))
+
+    def test_unknown_padding_scheme(self):
+        self.assertRaises(ValueError, EncryptedCharField, padding='zero')
+
     def test_none_value(self):
         """
         A value of None should be passed through without encryption.
@@ -322,11 +485,77 @@ class DateEncryptTests(unittest.TestCase):
         return important_dates[0]
 
 
+class CompactDateTests(unittest.TestCase):
+    def setUp(self):
+        CompactDateObject.objects.all().delete()
+
+    def _roundtrip(self, date, date_time):
+        obj = CompactDateObject.objects.create(
+            important_date=date, important_datetime=date_time)
+        return CompactDateObject.objects.get(id=obj.id)
+
+    def test_naive_values(self):
+        for date_time in (datetime.datetime(1, 1, 1),
+                          datetime.datetime(2024, 2, 29, 23, 59, 59, 999999),
+                          datetime.datetime(9999, 12, 31, 23, 59, 59, 999999)):
+            obj = self._roundtrip(date_time.date(), date_time)
+            self.assertEqual(obj.important_date, date_time.date())
+            self.assertEqual(obj.important_datetime, date_time)
+            self.assertEqual(obj.important_datetime.tzinfo, None)
+
+    def test_aware_values(self):
+        from django.utils.timezone import get_fixed_timezone
+        for minutes in (0, 330, -480):
+            date_time = datetime.datetime(
+                2020, 1, 1, 0, 30, 15, 123, get_fixed_timezone(minutes))
+            obj = self._roundtrip(datetime.date(2020, 1, 1), date_time)
+            self.assertEqual(obj.important_datetime, date_time)
+            self.assertEqual(
+                obj.important_datetime.utcoffset(), date_time.utcoffset())
+
+    def test_aware_values_out_of_range(self):
+        from django.utils.timezone import get_fixed_timezone
+        field = CompactDateObject._meta.get_field('important_datetime')
+        for date_time in (
+                datetime.datetime(1, 1, 1, tzinfo=get_fixed_timezone(60)),
+                datetime.datetime(9999, 12, 31, 23, 30,
+                                  tzinfo=get_fixed_timezone(-60))):
+            self.assertRaises(ValueError, field.get_db_prep_value, date_time)
+
+    def test_one_cipher_block(self):
+        obj = self._roundtrip(datetime.date.today(), datetime.datetime.now())
+        cursor = connection.cursor()
+        cursor.execute(
+            "select important_date, important_datetime from "
+            "django_fields_compactdateobject where id = %s", [obj.id])
+        for raw in cursor.fetchone():
+            # Prefix and the hex encoded IV + one block.
+            self.assertEqual(len(raw), len('$AES$MODE_CBC$') + 64)
+
+    def test_text_values_are_readable(self):
+        date_time = datetime.datetime(2019, 5, 6, 7, 8, 9, 10)
+        text_field = EncryptedDateTimeField(block_type='MODE_CBC')
+        field = CompactDateObject._meta.get_field('important_datetime')
+        self.assertEqual(
+            field.from_db_value(
+                text_field.get_db_prep_value(date_time), None, None, None),
+            date_time)
+        self.assertEqual(
+            field.from_db_values([text_field.get_db_prep_value(date_time),
+                                  field.get_db_prep_value(date_time), None]),
+            [date_time, date_time, None])
+
+    def test_printable_padding_is_rejected(self):
+        self.assertRaises(
+            ValueError, EncryptedDateField, compact=True, padding='printable')
+
+
 class NumberEncryptTests(unittest.TestCase):
     def setUp(self):
         EncInt.objects.all().delete()
         EncLong.objects.all().delete()
         EncFloat.objects.all().delete()
+        EncDecimal.objects.all().delete()
 
     def test_int_encryption(self):
         if PYTHON3 is True:
@@ -362,6 +591,10 @@ class NumberEncryptTests(unittest.TestCase):
             value = sys.maxint + (1.0 / 3.0)
         self._test_number_encryption(EncFloat, 'float', value)
 
+    def test_decimal_encryption(self):
+        self._test_number_encryption(
+            EncDecimal, 'decimal', decimal.Decimal('-12345.678900'))
+
     def _test_number_encryption(self, number_class, type_name, value):
         obj = number_class(important_number=value)
         obj.save()
@@ -382,6 +615,135 @@ class NumberEncryptTests(unittest.TestCase):
         return important_numbers[0]
 
 
+class CompactNumberTests(unittest.TestCase):
+    def setUp(self):
+        CompactNumberObject.objects.all().delete()
+
+    def test_roundtrip(self):
+        numbers = [0, 1, -1, 127, 128, -128, -129, 2 ** 63 - 1, -2 ** 63]
+        for number in numbers:
+            long_number = number * 10 ** 30 + 7
+            obj = CompactNumberObject.objects.create(
+                int_number=number, long_number=long_number)
+            obj = CompactNumberObject.objects.get(id=obj.id)
+            self.assertEqual(obj.int_number, number)
+            self.assertEqual(obj.long_number, long_number)
+
+    def test_one_cipher_block(self):
+        obj = CompactNumberObject.objects.create(
+            int_number=-2 ** 63, long_number=2 ** 100, float_number=1e-300)
+        cursor = connection.cursor()
+        cursor.execute(
+            "select int_number, long_number, float_number from "
+            "django_fields_compactnumberobject where id = %s", [obj.id])
+        for raw in cursor.fetchone():
+            # Prefix and the hex encoded IV + one block.
+            self.assertEqual(len(raw), len('$AES$MODE_CBC$') + 64)
+
+    def test_floats_and_decimals(self):
+        floats = [0.0, -0.0, 1e-300, 5e-324, 1.0 / 3, -1.7976931348623157e308,
+                  float('inf')]
+        decimals = ['0', '-0', '0.00', '-123.4500', '1E-30', '1E+30',
+                    '3.14159265358979323846264338327950288']
+        for number, text in zip(floats, decimals):
+            obj = CompactNumberObject.objects.create(
+                int_number=0, float_number=number,
+                decimal_number=decimal.Decimal(text))
+            obj = CompactNumberObject.objects.get(id=obj.id)
+            self.assertEqual(repr(obj.float_number), repr(number))
+            self.assertEqual(str(obj.decimal_number), text)
+        obj = CompactNumberObject.objects.create(
+            int_number=0, float_number=float('nan'))
+        obj = CompactNumberObject.objects.get(id=obj.id)
+        self.assertNotEqual(obj.float_number, obj.float_number)
+
+    def test_special_decimals(self):
+        field = CompactNumberObject._meta.get_field('decimal_number')
+        self.assertRaises(
+            ValueError, field.get_db_prep_value, decimal.Decimal('NaN'))
+        for text in ('1E+3000000000', '1E-3000000000'):
+            self.assertRaises(
+                ValueError, field.get_db_prep_value, decimal.Decimal(text))
+
+    def test_out_of_range(self):
+        field = CompactNumberObject._meta.get_field('int_number')
+        self.assertRaises(ValueError, field.get_db_prep_value, 2 ** 63)
+        self.assertRaises(
+            ValueError, field.get_db_prep_value, float('inf'))
+
+    def test_values_are_converted_as_in_text_mode(self):
+        for field_class, name in ((EncryptedIntField, 'int_number'),
+                                  (EncryptedLongField, 'long_number')):
+            text_field = field_class(block_type='MODE_CBC')
+            field = CompactNumberObject._meta.get_field(name)
+            for value in (3.7, -3.7, True, False, decimal.Decimal('12.9')):
+                self.assertEqual(
+                    field.from_db_value(
+                        field.get_db_prep_value(value), None, None, None),
+                    text_field.from_db_value(
+                        text_field.get_db_prep_value(value), None, None, None))
+
+    def test_text_values_are_readable(self):
+        for field_class, name in ((EncryptedIntField, 'int_number'),
+                                  (EncryptedLongField, 'long_number'),
+                                  (EncryptedFloatField, 'float_number'),
+                                  (EncryptedDecimalField, 'decimal_number')):
+            text_field = field_class(block_type='MODE_CBC')
+            field = CompactNumberObject._meta.get_field(name)
+            values = [text_field.get_db_prep_value(12345678),
+                      field.get_db_prep_value(12345678)]
+            self.assertEqual(field.from_db_values(values), [12345678] * 2)
+            self.assertEqual(text_field.from_db_values(values), [12345678] * 2)
+
+
+@unittest.skipIf(arrays.numpy is None, "requires numpy")
+class ArrayTests(unittest.TestCase):
+    def setUp(self):
+        CompactNumberObject.objects.all().delete()
+
+    def test_roundtrip(self):
+        numpy = arrays.numpy
+        ints = numpy.array([0, -1, 2 ** 63 - 1, -2 ** 63, 42], dtype='int64')
+        floats = numpy.array([0.0, -1.5, 1e-300, numpy.inf, 1.0 / 3])
+        int_field = CompactNumberObject._meta.get_field('int_number')
+        float_field = CompactNumberObject._meta.get_field('float_number')
+        encrypted_ints = arrays.encrypt_array(int_field, ints)
+        encrypted_floats = arrays.encrypt_array(float_field, floats)
+        self.assertTrue(all(value.startswith('$AES$MODE_CBC$')
+                            for value in encrypted_ints + encrypted_floats))
+        self.assertEqual(int_field.from_db_values(encrypted_ints), ints.tolist())
+
+        CompactNumberObject.objects.bulk_create([
+            CompactNumberObject(int_number=int_number, float_number=float_number)
+            for int_number, float_number in zip(encrypted_ints, encrypted_floats)
+        ])
+        queryset = CompactNumberObject.objects.order_by('id')
+        int_array = queryset.values_array('int_number')
+        float_array = queryset.values_array('float_number')
+        self.assertEqual(int_array.dtype, numpy.dtype('int64'))
+        self.assertTrue((int_array == ints).all())
+        self.assertTrue((float_array == floats).all())
+
+    def test_other_encodings(self):
+        numpy = arrays.numpy
+        field = CompactNumberObject._meta.get_field('float_number')
+        text_field = EncryptedFloatField(block_type='MODE_CBC')
+        values = [field.get_db_prep_value(1.25), None,
+                  text_field.get_db_prep_value(2.5)]
+        array = arrays.decrypt_array(field, values)
+        self.assertEqual(array[0], 1.25)
+        self.assertTrue(numpy.isnan(array[1]))
+        self.assertEqual(array[2], 2.5)
+        int_field = CompactNumberObject._meta.get_field('int_number')
+        self.assertRaises(ValueError, arrays.decrypt_array, int_field, [None])
+
+    def test_unsupported_fields(self):
+        self.assertRaises(
+            ValueError, arrays.decrypt_array, EncryptedLongField(), [])
+        self.assertRaises(
+            ValueError, arrays.encrypt_array, EncryptedIntField(), [1])
+
+
 class TestPickleField(unittest.TestCase):
     def setUp(self):
         PickleObject.objects.all().delete()
@@ -424,6 +786,64 @@ class TestPickleField(unittest.TestCase):
         self.assertEqual(obj.data, value)
 
 
+class BinaryPickleFieldTests(unittest.TestCase):
+    def setUp(self):
+        BinaryPickleObject.objects.all().delete()
+
+    def _raw(self, obj):
+        cursor = connection.cursor()
+        cursor.execute(
+            "select data, buffers from django_fields_binarypickleobject "
+            "where id = %s", [obj.id])
+        return [bytes(value) for value in cursor.fetchone()]
+
+    def test_roundtrip(self):
+        data = {'items': [1, 2.5, u'три'], 'blob': b'x' * 1000}
+        obj = BinaryPickleObject.objects.create(data=data, buffers=data)
+        obj = BinaryPickleObject.objects.get(id=obj.id)
+        self.assertEqual(obj.data, data)
+        self.assertEqual(obj.buffers, data)
+        raw_data, raw_buffers = self._raw(obj)
+        self.assertTrue(raw_data.startswith(b'\x80'))
+        self.assertLess(len(raw_data), 1100)
+
+    @unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5 or arrays.numpy is None,
+                     "requires pickle protocol 5 and numpy")
+    def test_out_of_band_buffers(self):
+        numpy = arrays.numpy
+        first = numpy.arange(10000, dtype='float64')
+        second = numpy.ones((100, 10), dtype='int32')
+        obj = BinaryPickleObject.objects.create(
+            buffers={'first': first, 'second': second, 'name': 'arrays'})
+        obj = BinaryPickleObject.objects.get(id=obj.id)
+        self.assertTrue((obj.buffers['first'] == first).all())
+        self.assertTrue((obj.buffers['second'] == second).all())
+        self.assertEqual(obj.buffers['name'], 'arrays')
+        raw_buffers = self._raw(obj)[1]
+        self.assertTrue(raw_buffers.startswith(b'\x00'))
+        self.assertLess(
+            len(raw_buffers), first.nbytes + second.nbytes + 500)
+
+    def test_legacy_base64_values(self):
+        field = BinaryPickleObject._meta.get_field('data')
+        legacy = PickleObject._meta.get_field('data').get_db_prep_value(
+            {'a': 1})
+        self.assertEqual(field.from_db_value(legacy, None, None, None), {'a': 1})
+        self.assertEqual(
+            field.from_db_value(legacy.encode('ascii'), None, None, None),
+            {'a': 1})
+
+    def test_protocol_validation(self):
+        self.assertRaises(
+            ValueError, PickleField, protocol=pickle.HIGHEST_PROTOCOL + 1)
+        self.assertRaises(ValueError, PickleField, storage='binary', protocol=1)
+        self.assertRaises(ValueError, PickleField, storage='json')
+        field = PickleField(protocol=0)
+        value = field.get_db_prep_value([1, 2])
+        self.assertEqual(
+            pickle.loads(codecs.decode(value.encode(), 'base64')), [1, 2])
+
+
 class EncryptEmailTests(unittest.TestCase):
 
     def setUp(self):
@@ -545,3 +965,1003 @@ class DatabaseSchemaTests(unittest.TestCase):
         else:
             raw_type = password_field.internal_size
             return raw_type
+
+
+class BulkDecryptTests(unittest.TestCase):
+    def setUp(self):
+        BulkEncObject.objects.all().delete()
+
+    def test_bulk_decrypt(self):
+        today = datetime.date.today()
+        expected = {}
+        for index in range(7):
+            password = u'пароль %d' % index * (index + 1)
+            obj = BulkEncObject.objects.create(
+                password=password[:20],
+                cipher_password=None if index == 3 else password[-20:],
+                important_date=today - datetime.timedelta(days=index),
+            )
+            expected[obj.id] = obj
+
+        objs = list(BulkEncObject.objects.order_by('id').bulk_decrypt(chunk_size=3))
+        self.assertEqual(len(objs), 7)
+        for obj in objs:
+            original = expected[obj.id]
+            self.assertEqual(obj.password, original.password)
+            self.assertEqual(obj.cipher_password, original.cipher_password)
+            self.assertEqual(obj.important_date, original.important_date)
+            self.assertFalse(hasattr(obj, '_raw_password'))
+
+    def test_inherited_fields(self):
+        InheritedChild.objects.all().delete()
+        for index in range(5):
+            InheritedChild.objects.create(
+                secret='secret %d' % index, note='note %d' % index)
+        objs = list(InheritedChild.objects.order_by('id').bulk_decrypt(
+            chunk_size=2))
+        self.assertEqual(
+            [(obj.secret, obj.note) for obj in objs],
+            [('secret %d' % index, 'note %d' % index) for index in range(5)])
+
+    def test_decrypt_many(self):
+        field = BulkEncObject._meta.get_field('cipher_password')
+        values = ['one', None, 'three' * 4]
+        encrypted = [field.get_db_prep_value(value) for value in values]
+        self.assertEqual(field.decrypt_many(encrypted), values)
+
+
+class ThreadSafetyTests(unittest.TestCase):
+    def test_concurrent_encryption(self):
+        """
+        Fields keep no per-call state, so they can be shared by threads.
+        """
+        field = BulkEncObject._meta.get_field('cipher_password')
+        errors = []
+
+        def worker(index):
+            for round in range(200):
+                value = u'thread %d round %d' % (index, round)
+                try:
+                    encrypted = field.get_db_prep_value(value)
+                    decrypted = field.from_db_value(encrypted, None, None, None)
+                    if decrypted != value:
+                        errors.append((value, decrypted))
+                except Exception as e:
+                    errors.append((value, e))
+
+        threads = [threading.Thread(target=worker, args=(index,))
+                   for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class CompactStorageTests(unittest.TestCase):
+    def setUp(self):
+        CompactEncObject.objects.all().delete()
+
+    def test_binary_and_base64_storage(self):
+        password = 'a' * CompactEncObject.max_password
+        text = u'совершенно секретно' * 10
+        obj = CompactEncObject.objects.create(password=password, text=text)
+        obj = CompactEncObject.objects.get(id=obj.id)
+        self.assertEqual(password, obj.password)
+        self.assertEqual(text, obj.text)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "select password, text from django_fields_compactencobject "
+            "where id = %s", [obj.id])
+        raw_password, raw_text = cursor.fetchone()
+        raw_password = bytes(raw_password)
+        self.assertTrue(raw_password.startswith(b'\xdf'))
+        self.assertLessEqual(
+            len(raw_password),
+            CompactEncObject._meta.get_field('password').max_length)
+        self.assertTrue(raw_text.startswith('$b64$'))
+
+    def test_none_value(self):
+        obj = CompactEncObject.objects.create(password=None, text='')
+        obj = CompactEncObject.objects.get(id=obj.id)
+        self.assertEqual(obj.password, None)
+        self.assertEqual(obj.text, '')
+
+    def test_legacy_hex_values_are_readable(self):
+        legacy = CipherEncObject._meta.get_field('password')
+        field = CompactEncObject._meta.get_field('password')
+        encrypted = legacy.get_db_prep_value('password')
+        self.assertEqual(
+            field.from_db_value(encrypted, None, None, None), 'password')
+        self.assertEqual(
+            field.decrypt_many([encrypted, None, field.get_db_prep_value('x')]),
+            ['password', None, 'x'])
+
+    def test_other_block_types_require_accept_legacy(self):
+        field = CompactEncObject._meta.get_field('password')
+        ecb_field = EncryptedCharField(max_length=20, storage='binary')
+        encrypted = ecb_field.get_db_prep_value('password')
+        self.assertFalse(field._is_encrypted(encrypted))
+        self.assertRaises(
+            ValueError, field.from_db_value, encrypted, None, None, None)
+        legacy_field = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC', storage='binary',
+            accept_legacy=True)
+        self.assertEqual(
+            legacy_field.from_db_value(encrypted, None, None, None), 'password')
+
+    def test_other_ciphers_are_rejected(self):
+        field = CompactEncObject._meta.get_field('password')
+        # A CBC value of Blowfish (cipher id 3).
+        encrypted = b'\xdf\x01\x32\x00' + b'x' * 32
+        self.assertRaises(
+            ValueError, field.from_db_value, encrypted, None, None, None)
+
+    def test_base85_storage(self):
+        if PYTHON3 is False:
+            self.assertRaises(ValueError, EncryptedCharField, storage='base85')
+            return
+        field = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC', storage='base85')
+        encrypted = field.get_db_prep_value('a' * 20)
+        self.assertTrue(encrypted.startswith('$b85$'))
+        self.assertLessEqual(len(encrypted), field.max_length)
+        self.assertEqual(
+            field.from_db_value(encrypted, None, None, None), 'a' * 20)
+
+
+class FormatDetectionTests(unittest.TestCase):
+    def setUp(self):
+        self.field = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC', storage='base64')
+
+    def test_classify(self):
+        ecb_hex = EncryptedCharField(max_length=20).get_db_prep_value('x')
+        cbc_hex = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC').get_db_prep_value('x')
+        binary = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC',
+            storage='binary').get_db_prep_value('x')
+        base64_value = self.field.get_db_prep_value('x')
+        classify = self.field._classify
+        self.assertEqual(classify(ecb_hex), ('hex', ecb_hex))
+        self.assertEqual(classify(cbc_hex), ('hex', cbc_hex))
+        self.assertEqual(classify(binary)[0], 'binary')
+        self.assertEqual(classify(base64_value), ('base64', base64_value))
+        for plaintext in ('plain', '$dollars', '', None, 42):
+            self.assertEqual(classify(plaintext), None)
+        for value in (cbc_hex, binary, base64_value):
+            self.assertTrue(self.field._is_encrypted(value))
+            self.assertEqual(self.field.from_db_value(value, None, None, None), 'x')
+        self.assertFalse(self.field._is_encrypted(ecb_hex))
+        self.assertRaises(
+            ValueError, self.field.from_db_value, ecb_hex, None, None, None)
+
+    def test_values_which_only_look_encrypted(self):
+        field = EncryptedCharField(max_length=100, block_type='MODE_CBC')
+        valid = field.get_db_prep_value('x')
+        body = valid[len(field.prefix):]
+        for value in ('$AES$hunter2', '$AES$', '$AES$MODE_CBC$',
+                      '$AES$MODE_CBC$abcd', valid[:-2], valid + '0',
+                      valid[:-1] + 'g', field.prefix + body[:32],
+                      field.prefix + 'k999$' + body,
+                      '$AES$MODE_XYZ$' + body):
+            self.assertFalse(field._is_encrypted(value))
+            encrypted = field.get_db_prep_value(value)
+            self.assertNotEqual(encrypted, value)
+            self.assertEqual(
+                field.from_db_value(encrypted, None, None, None), value)
+        self.assertTrue(field._is_encrypted(valid))
+        self.assertTrue(field._is_encrypted(valid.upper().replace(
+            field.prefix.upper(), field.prefix)))
+
+    def test_invalid_hex_digits_are_rejected_on_read(self):
+        # Only the digits at both ends are checked by _is_encrypted.
+        field = EncryptedTextField(block_type='MODE_CBC')
+        valid = field.get_db_prep_value('x' * 100)
+        middle = len(valid) // 2
+        corrupt = valid[:middle] + 'zz' + valid[middle + 2:]
+        self.assertTrue(field._is_encrypted(corrupt))
+        self.assertRaises(
+            ValueError, field.from_db_value, corrupt, None, None, None)
+        self.assertRaises(ValueError, field.decrypt_many, [valid, corrupt])
+
+    def test_text_formats_as_bytes(self):
+        hex_value = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC').get_db_prep_value('x')
+        raw = hex_value.encode('ascii')
+        self.assertEqual(self.field._classify(raw), ('hex', hex_value))
+        self.assertTrue(self.field._is_encrypted(raw))
+        self.assertEqual(self.field.from_db_value(raw, None, None, None), 'x')
+        self.assertEqual(self.field._classify(b'plain'), None)
+
+    def test_only_the_header_is_read(self):
+        # _is_encrypted decodes the header from the first characters and
+        # never the whole value.
+        value = self.field.get_db_prep_value('x')
+        self.assertTrue(self.field._is_encrypted(value[:13] + '!' * 10))
+        self.assertFalse(self.field._is_encrypted('$b64$' + 'AAAA' * 8))
+
+
+class BulkEncryptTests(unittest.TestCase):
+    def setUp(self):
+        BulkEncObject.objects.all().delete()
+
+    def test_bulk_create(self):
+        today = datetime.date.today()
+        objs = [
+            BulkEncObject(
+                password='password %d' % index,
+                cipher_password=None if index == 3 else 'x' * index,
+                important_date=today - datetime.timedelta(days=index),
+            )
+            for index in range(20)
+        ]
+        BulkEncObject.objects.bulk_create(objs)
+        self.assertEqual(objs[5].password, 'password 5')
+
+        for index, obj in enumerate(BulkEncObject.objects.order_by('id')):
+            self.assertEqual(obj.password, 'password %d' % index)
+            self.assertEqual(
+                obj.cipher_password, None if index == 3 else 'x' * index)
+            self.assertEqual(
+                obj.important_date, today - datetime.timedelta(days=index))
+
+    def test_encrypt_many(self):
+        field = BulkEncObject._meta.get_field('cipher_password')
+        values = ['a' * length for length in range(21)] * 3 + [None]
+        encrypted = field.encrypt_many(values)
+        self.assertEqual(len(set(encrypted)), len(encrypted))
+        self.assertEqual(
+            [field.from_db_value(value, None, None, None) for value in encrypted],
+            values)
+
+        field = CompactEncObject._meta.get_field('text')
+        values = [u'ж' * length for length in range(0, 1000, 50)] * 2
+        encrypted = field.encrypt_many(values)
+        self.assertEqual(
+            [field.from_db_value(value, None, None, None) for value in encrypted],
+            values)
+
+
+class BlindIndexTests(unittest.TestCase):
+    def setUp(self):
+        BlindIndexObject.objects.all().delete()
+
+    def test_index_field_is_added(self):
+        field = BlindIndexObject._meta.get_field('email_bidx')
+        self.assertTrue(field.db_index)
+        self.assertEqual(field.source, 'email')
+
+    def test_lookups(self):
+        obj = BlindIndexObject.objects.create(email='test@example.com')
+        BlindIndexObject.objects.create(email='other@example.com')
+        BlindIndexObject.objects.create(email=None)
+
+        self.assertEqual(
+            BlindIndexObject.objects.get(email='test@example.com').id, obj.id)
+        self.assertEqual(
+            BlindIndexObject.objects.filter(email='nobody@example.com').count(), 0)
+        self.assertEqual(
+            BlindIndexObject.objects.exclude(email='test@example.com').count(), 2)
+        self.assertEqual(
+            BlindIndexObject.objects.filter(
+                email__in=['test@example.com', 'other@example.com']).count(), 2)
+        self.assertEqual(
+            BlindIndexObject.objects.filter(email__isnull=True).count(), 1)
+
+        query = str(BlindIndexObject.objects.filter(email='test@example.com').query)
+        self.assertTrue('email_bidx' in query)
+
+    def test_index_follows_changes(self):
+        obj = BlindIndexObject.objects.create(email='test@example.com')
+        obj.email = 'changed@example.com'
+        obj.save()
+        self.assertEqual(
+            BlindIndexObject.objects.get(email='changed@example.com').id, obj.id)
+
+        BlindIndexObject.objects.filter(id=obj.id).update(email='new@example.com')
+        self.assertEqual(
+            BlindIndexObject.objects.get(email='new@example.com').email,
+            'new@example.com')
+
+    def test_bulk_create(self):
+        BlindIndexObject.objects.bulk_create([
+            BlindIndexObject(email='user%d@example.com' % index)
+            for index in range(5)
+        ])
+        self.assertEqual(
+            BlindIndexObject.objects.get(email='user3@example.com').email,
+            'user3@example.com')
+
+    @unittest.skipIf(django.VERSION < (2, 2), "requires bulk_update()")
+    def test_bulk_update(self):
+        objs = [BlindIndexObject.objects.create(email='user%d@example.com' % index)
+                for index in range(3)]
+        for index, obj in enumerate(objs):
+            obj.email = 'changed%d@example.com' % index
+        BlindIndexObject.objects.bulk_update(objs, ['email'])
+        self.assertEqual(
+            BlindIndexObject.objects.get(email='changed1@example.com').id,
+            objs[1].id)
+        self.assertEqual(
+            BlindIndexObject.objects.filter(email='user1@example.com').count(), 0)
+
+
+class DecryptionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.maxsize, self.ttl = decryption_cache.maxsize, decryption_cache.ttl
+        decryption_cache.maxsize = 3
+        decryption_cache.ttl = None
+        decryption_cache.clear()
+
+    def tearDown(self):
+        decryption_cache.maxsize, decryption_cache.ttl = self.maxsize, self.ttl
+        decryption_cache.clear()
+
+    def test_hits_and_misses(self):
+        field = CipherEncObject._meta.get_field('password')
+        encrypted = field.get_db_prep_value('password')
+        for index in range(3):
+            self.assertEqual(
+                field.from_db_value(encrypted, None, None, None), 'password')
+        self.assertEqual((decryption_cache.hits, decryption_cache.misses), (2, 1))
+        self.assertEqual(field.decrypt_many([encrypted, None]), ['password', None])
+        self.assertEqual(decryption_cache.hits, 3)
+
+    def test_size_limit(self):
+        field = CipherEncObject._meta.get_field('password')
+        encrypted = field.encrypt_many(['one', 'two', 'three', 'four'])
+        self.assertEqual(
+            field.decrypt_many(encrypted), ['one', 'two', 'three', 'four'])
+        self.assertEqual(len(decryption_cache), 3)
+        # The least recently used value was evicted.
+        field.from_db_value(encrypted[0], None, None, None)
+        self.assertEqual(decryption_cache.hits, 0)
+
+    def test_ttl(self):
+        decryption_cache.ttl = -1
+        field = CipherEncObject._meta.get_field('password')
+        encrypted = field.get_db_prep_value('password')
+        field.from_db_value(encrypted, None, None, None)
+        field.from_db_value(encrypted, None, None, None)
+        self.assertEqual(decryption_cache.hits, 0)
+
+    def test_only_encrypted_values_are_cached(self):
+        decryption_cache.maxsize = 10
+        field = CipherEncObject._meta.get_field('password')
+        encrypted = field.encrypt_many(['a', 'b', 'c'])
+        self.assertEqual(field.from_db_values(encrypted), ['a', 'b', 'c'])
+        self.assertEqual(len(decryption_cache), 3)
+        self.assertEqual(decryption_cache.misses, 3)
+        self.assertEqual(field.from_db_value('plain', None, None, None), 'plain')
+        self.assertEqual(len(decryption_cache), 3)
+        self.assertEqual(decryption_cache.misses, 3)
+
+    def test_disabled_for_field(self):
+        field = EncryptedCharField(block_type='MODE_CBC', cache=False)
+        encrypted = field.get_db_prep_value('password')
+        field.from_db_value(encrypted, None, None, None)
+        field.decrypt_many([encrypted])
+        self.assertEqual(len(decryption_cache), 0)
+
+
+class LazyDecryptionTests(unittest.TestCase):
+    def setUp(self):
+        LazyEncObject.objects.all().delete()
+
+    def test_decrypts_on_access(self):
+        today = datetime.date.today()
+        obj = LazyEncObject.objects.create(password='password', important_date=today)
+        obj = LazyEncObject.objects.get(id=obj.id)
+        self.assertTrue(
+            obj.__dict__['password'].value.startswith('$AES$MODE_CBC$'))
+        self.assertEqual(obj.password, 'password')
+        self.assertEqual(obj.__dict__['password'], 'password')
+        self.assertEqual(obj.important_date, today)
+
+    def test_untouched_values_are_saved_unchanged(self):
+        obj = LazyEncObject.objects.create(
+            password='password', important_date=datetime.date.today())
+        obj = LazyEncObject.objects.get(id=obj.id)
+        encrypted = obj.__dict__['password'].value
+        obj.save()
+        self.assertEqual(
+            LazyEncObject.objects.get(id=obj.id).__dict__['password'].value,
+            encrypted)
+
+        obj.password = 'changed'
+        obj.save()
+        self.assertEqual(LazyEncObject.objects.get(id=obj.id).password, 'changed')
+
+    def test_unreadable_values(self):
+        # A legacy ECB value, which the MODE_CBC field doesn't read.
+        obj = LazyEncObject.objects.create(
+            password='password', important_date=datetime.date.today())
+        legacy = EncryptedCharField(max_length=20).get_db_prep_value('legacy')
+        cursor = connection.cursor()
+        cursor.execute(
+            "update django_fields_lazyencobject set password = %s "
+            "where id = %s", [legacy, obj.pk])
+        obj = LazyEncObject.objects.get(id=obj.id)
+        obj.save()
+        obj = LazyEncObject.objects.get(id=obj.id)
+        self.assertEqual(obj.__dict__['password'].value, legacy)
+        self.assertRaises(ValueError, getattr, obj, 'password')
+
+    def test_deferred(self):
+        obj = LazyEncObject.objects.create(
+            password='password', important_date=datetime.date.today())
+        obj = LazyEncObject.objects.defer('password').get(id=obj.id)
+        self.assertEqual(obj.password, 'password')
+
+    def test_values_are_decrypted(self):
+        today = datetime.date.today()
+        obj = LazyEncObject.objects.create(password='password', important_date=today)
+        self.assertEqual(
+            list(LazyEncObject.objects.filter(id=obj.id).values_list(
+                'password', 'important_date')),
+            [('password', today)])
+        self.assertEqual(
+            LazyEncObject.objects.values('password').get(id=obj.id),
+            {'password': 'password'})
+
+    def test_only(self):
+        obj = LazyEncObject.objects.create(
+            password='password', important_date=datetime.date.today())
+        obj = LazyEncObject.objects.only('id', 'password').get(id=obj.id)
+        self.assertTrue(
+            obj.__dict__['password'].value.startswith('$AES$MODE_CBC$'))
+        self.assertNotIn('important_date', obj.__dict__)
+        self.assertEqual(obj.password, 'password')
+
+
+class StreamingTests(unittest.TestCase):
+    def setUp(self):
+        BulkEncObject.objects.all().delete()
+        today = datetime.date.today()
+        BulkEncObject.objects.bulk_create([
+            BulkEncObject(
+                password='password %d' % index,
+                cipher_password=None if index == 3 else 'x' * index,
+                important_date=today - datetime.timedelta(days=index),
+            )
+            for index in range(10)
+        ])
+
+    def test_stream_values(self):
+        queryset = BulkEncObject.objects.order_by('id')
+        self.assertEqual(
+            list(queryset.stream_values(chunk_size=3)),
+            [dict((field.attname, getattr(obj, field.attname))
+                  for field in BulkEncObject._meta.concrete_fields)
+             for obj in queryset])
+
+    def test_stream_values_with_executor(self):
+        if parallel.futures is None:
+            return
+        queryset = BulkEncObject.objects.order_by('id')
+        with parallel.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            rows = list(queryset.stream_values_list(
+                'id', 'password', 'important_date',
+                chunk_size=3, executor=executor, max_pending=2))
+        self.assertEqual(
+            rows,
+            [(obj.id, obj.password, obj.important_date) for obj in queryset])
+
+    def test_stream_values_list(self):
+        queryset = BulkEncObject.objects.order_by('id')
+        self.assertEqual(
+            list(queryset.stream_values_list(
+                'id', 'cipher_password', 'important_date', chunk_size=4)),
+            [(obj.id, obj.cipher_password, obj.important_date)
+             for obj in queryset])
+
+    def test_inherited_fields(self):
+        InheritedChild.objects.all().delete()
+        for index in range(5):
+            InheritedChild.objects.create(
+                secret='secret %d' % index, note='note %d' % index)
+        self.assertEqual(
+            list(InheritedChild.objects.order_by('id').stream_values_list(
+                'secret', 'note', chunk_size=2)),
+            [('secret %d' % index, 'note %d' % index) for index in range(5)])
+
+
+class ParallelTests(unittest.TestCase):
+    def test_encrypt_and_decrypt(self):
+        if parallel.futures is None:
+            return
+        field = BulkEncObject._meta.get_field('important_date')
+        today = datetime.date.today()
+        values = [today - datetime.timedelta(days=index) for index in range(25)]
+        with parallel.get_executor(field, max_workers=2) as executor:
+            encrypted = parallel.encrypt_parallel(
+                field, values, executor=executor, chunk_size=10)
+            self.assertEqual(len(encrypted), 25)
+            self.assertEqual(
+                parallel.decrypt_parallel(
+                    field, encrypted, executor=executor, chunk_size=7),
+                values)
+
+
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        BulkEncObject.objects.all().delete()
+        BulkEncObject.objects.bulk_create([
+            BulkEncObject(
+                password='password %d' % index,
+                cipher_password='x' * index,
+                important_date=datetime.date.today(),
+            )
+            for index in range(5)
+        ])
+
+    def _run(self, coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_astream_values(self):
+        if sys.version_info < (3, 6):
+            return
+        from . import aio
+        queryset = BulkEncObject.objects.order_by('id')
+        expected = [(obj.id, obj.cipher_password) for obj in queryset]
+
+        async def collect(threshold):
+            return [row async for row in aio.astream_values(
+                queryset, 'id', 'cipher_password', chunk_size=2,
+                as_dict=False, threshold=threshold)]
+
+        self.assertEqual(self._run(collect(0)), expected)
+        self.assertEqual(self._run(collect(10 ** 6)), expected)
+
+    def test_adecrypt(self):
+        if sys.version_info < (3, 6):
+            return
+        from . import aio
+        field = BulkEncObject._meta.get_field('cipher_password')
+        encrypted = field.encrypt_many(['one', 'two'])
+        self.assertEqual(
+            self._run(aio.adecrypt(field, encrypted[0], threshold=0)), 'one')
+        self.assertEqual(
+            self._run(aio.adecrypt_many(field, encrypted)), ['one', 'two'])
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.callback = lambda *args: self.calls.append(args)
+
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics.enabled)
+
+    def test_callback(self):
+        field = BulkEncObject._meta.get_field('cipher_password')
+        metrics.register(self.callback)
+        try:
+            self.assertTrue(metrics.enabled)
+            encrypted = field.encrypt_many(['one', 'two', None])
+            field.decrypt_many(encrypted)
+            field.from_db_value(encrypted[0], None, None, None)
+        finally:
+            metrics.unregister(self.callback)
+        self.assertFalse(metrics.enabled)
+        self.assertEqual(
+            [(call[0], call[1], call[2]) for call in self.calls],
+            [(field, 'encrypt', 2), (field, 'decrypt', 2),
+             (field, 'decrypt', 1)])
+        # Two values of an IV and a padded block each.
+        self.assertEqual(self.calls[0][3], 2 * 2 * field.block_size)
+        self.assertTrue(all(call[4] >= 0 for call in self.calls))
+
+    def test_collect(self):
+        PickleObject.objects.create(name='metrics', data={'a': 1})
+        field = EncObject._meta.get_field('password')
+        other_thread = threading.Thread(
+            target=lambda: field.get_db_prep_value('other'))
+        with metrics.collect() as summary:
+            obj = EncObject.objects.create(password='secret')
+            other_thread.start()
+            other_thread.join()
+            EncObject.objects.get(pk=obj.pk)
+            PickleObject.objects.get(name='metrics')
+        self.assertFalse(metrics.enabled)
+        self.assertEqual(summary.stats[('EncObject.password', 'encrypt')].count, 1)
+        self.assertEqual(summary.stats[('EncObject.password', 'decrypt')].count, 1)
+        self.assertEqual(summary.totals()['pickle_load'].count, 1)
+        self.assertIn('encrypt: 1 values', str(summary))
+
+
+class BackendTests(unittest.TestCase):
+    def _backends(self):
+        available = [backends.PycryptoBackend()]
+        try:
+            available.append(backends.CryptographyBackend())
+        except ImportError:
+            pass
+        return available
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, backends.load_backend, 'rot13')
+
+    def test_backends_are_compatible(self):
+        # Every backend decrypts what the others encrypted.
+        secret_key = 'k' * 32
+        plaintext = b'0123456789abcdef' * 4
+        iv = b'i' * 16
+        for block_type in (None, 'MODE_CBC', 'MODE_CFB', 'MODE_OFB'):
+            factories = [
+                CipherFactory(backend.get_cipher('AES'), block_type, secret_key)
+                for backend in self._backends()
+            ]
+            encrypted = [factory.new(iv).encrypt(plaintext)
+                         for factory in factories]
+            self.assertEqual(len(set(encrypted)), 1)
+            for factory in factories:
+                self.assertEqual(
+                    factory.new(iv).decrypt(encrypted[0]), plaintext)
+
+    def test_partial_blocks_are_rejected(self):
+        # A corrupt value must not leave a partial block behind in the
+        # (per-thread) ECB cipher, which would break later values.
+        secret_key = 'k' * 32
+        plaintext = b'0123456789abcdef'
+        for backend in self._backends():
+            for block_type in (None, 'MODE_CBC'):
+                factory = CipherFactory(
+                    backend.get_cipher('AES'), block_type, secret_key)
+                encrypted = factory.new(b'i' * 16).encrypt(plaintext)
+                cipher = factory.new(b'i' * 16)
+                self.assertRaises(ValueError, cipher.decrypt, b'corrupt')
+                self.assertEqual(cipher.decrypt(encrypted), plaintext)
+                cipher = factory.new(b'i' * 16)
+                self.assertRaises(ValueError, cipher.encrypt, b'corrupt')
+                self.assertEqual(cipher.encrypt(plaintext), encrypted)
+
+    def test_missing_cryptography_modes(self):
+        try:
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.hazmat.primitives.ciphers import algorithms, modes
+        except ImportError:
+            return
+
+        class OnlyCBC(object):
+            ECB = modes.ECB
+            CBC = modes.CBC
+
+        cipher = backends.CryptographyCipher(
+            algorithms.AES, (OnlyCBC,), default_backend())
+        key = b'k' * 32
+        iv = b'i' * 16
+        self.assertEqual(
+            len(cipher.new(key, cipher.MODE_CBC, iv).encrypt(b'x' * 16)), 16)
+        self.assertRaises(ValueError, cipher.new, key, cipher.MODE_CFB, iv)
+        self.assertRaises(ValueError, cipher.new, key, cipher.MODE_OFB, iv)
+
+    def test_aead_backends_are_compatible(self):
+        key = b'k' * 32
+        nonce = b'n' * 12
+        for block_type, cipher_type in backends.AEAD_MODES.items():
+            aeads = [backend.get_aead(cipher_type, block_type).new(key)
+                     for backend in self._backends()]
+            encrypted = [aead.encrypt(nonce, b'secret') for aead in aeads]
+            self.assertEqual(len(set(encrypted)), 1)
+            for aead in aeads:
+                self.assertEqual(aead.decrypt(nonce, encrypted[0]), b'secret')
+                self.assertRaises(
+                    ValueError, aead.decrypt, nonce, b'x' + encrypted[0][1:])
+
+    def test_releases_gil(self):
+        for backend in self._backends():
+            factory = CipherFactory(backend.get_cipher('AES'), 'MODE_CBC', 'k' * 32)
+            self.assertEqual(factory.releases_gil, backend.releases_gil)
+
+
+class AEADTests(unittest.TestCase):
+    def setUp(self):
+        AEADEncObject.objects.all().delete()
+
+    def test_values_of_other_block_types_are_rejected(self):
+        # CBC values can be altered without the key: flipping bits of the
+        # IV flips the same bits of the first plaintext block.
+        field = EncryptedTextField(block_type='MODE_GCM')
+        cbc_field = EncryptedTextField(block_type='MODE_CBC')
+        encrypted = cbc_field.get_db_prep_value('role=user;x')
+        raw = bytearray(binascii.a2b_hex(encrypted[len(cbc_field.prefix):]))
+        for index, (old, new) in enumerate(
+                zip(bytearray(b'user'), bytearray(b'root'))):
+            raw[5 + index] ^= old ^ new
+        tampered = cbc_field.prefix + binascii.b2a_hex(bytes(raw)).decode('ascii')
+        self.assertEqual(
+            cbc_field.from_db_value(tampered, None, None, None), 'role=root;x')
+        self.assertFalse(field._is_encrypted(tampered))
+        self.assertRaises(
+            ValueError, field.from_db_value, tampered, None, None, None)
+        self.assertRaises(ValueError, field.decrypt_many, [tampered])
+
+    def test_round_trip(self):
+        text = u'совершенно секретно' * 10
+        today = datetime.date.today()
+        obj = AEADEncObject.objects.create(
+            password='a' * AEADEncObject.max_password, text=text,
+            important_date=today)
+        obj = AEADEncObject.objects.get(id=obj.id)
+        self.assertEqual(obj.password, 'a' * AEADEncObject.max_password)
+        self.assertEqual(obj.text, text)
+        self.assertEqual(obj.important_date, today)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "select password from django_fields_aeadencobject "
+            "where id = %s", [obj.id])
+        raw_password = bytes(cursor.fetchone()[0])
+        self.assertEqual(
+            len(raw_password),
+            AEADEncObject._meta.get_field('password').max_length)
+
+    def test_no_padding(self):
+        field = AEADEncObject._meta.get_field('text')
+        self.assertEqual(field.cipher_type, 'ChaCha20')
+        for value in ('', 'a', 'a' * 100):
+            encrypted = field.get_db_prep_value(value)
+            # Constant overhead: prefix, nonce and tag.
+            self.assertEqual(
+                len(encrypted), len(field.prefix) + (12 + 16 + len(value)) * 2)
+            self.assertEqual(
+                field.from_db_value(encrypted, None, None, None), value)
+        self.assertEqual(
+            field.decrypt_many(field.encrypt_many(['x', None, 'yz'])),
+            ['x', None, 'yz'])
+
+    def test_tampered_value(self):
+        field = AEADEncObject._meta.get_field('text')
+        encrypted = field.get_db_prep_value('secret')
+        last = '0' if encrypted[-1] != '0' else '1'
+        self.assertRaises(
+            ValueError, field.from_db_value, encrypted[:-1] + last,
+            None, None, None)
+
+    def test_wrong_cipher(self):
+        self.assertRaises(
+            ValueError, EncryptedCharField, cipher='Blowfish',
+            block_type='MODE_GCM')
+
+
+class KeyRegistryTests(unittest.TestCase):
+    def setUp(self):
+        from . import fields
+        self.fields = fields
+        self.original_registry = fields.key_registry
+
+    def tearDown(self):
+        self.fields.key_registry = self.original_registry
+
+    def _field(self, active_key_id, **kwargs):
+        self.fields.key_registry = keys.KeyRegistry(
+            {1: 'first secret', 2: 'second secret'}, active_key_id)
+        return EncryptedCharField(max_length=20, **kwargs)
+
+    def test_registry(self):
+        registry = keys.KeyRegistry({1: 'a', 3: 'b'})
+        self.assertEqual(registry.active_key_id, 3)
+        self.assertEqual(len(registry.derive(1, 'cipher.AES')), 32)
+        self.assertTrue(
+            registry.derive(1, 'cipher.AES') is registry.derive(1, 'cipher.AES'))
+        self.assertNotEqual(
+            registry.derive(1, 'cipher.AES'), registry.derive(3, 'cipher.AES'))
+        self.assertRaises(ValueError, registry.get, 2)
+        self.assertRaises(ValueError, keys.KeyRegistry, {256: 'x'})
+        self.assertRaises(ValueError, keys.KeyRegistry, {1: 'x'}, 2)
+        self.assertEqual(keys.KeyRegistry().active_key_id, 0)
+
+    def test_multi_key_reads(self):
+        for kwargs in ({'block_type': 'MODE_CBC'}, {},
+                       {'block_type': 'MODE_GCM', 'storage': 'base64'}):
+            legacy = EncryptedCharField(max_length=20, **kwargs)
+            old = self._field(1, **kwargs)
+            new = self._field(2, **kwargs)
+            self.assertEqual(new.key_id, 2)
+            values = (
+                legacy.encrypt_many(['legacy']) + old.encrypt_many(['old']) +
+                new.encrypt_many(['new', None]))
+            self.assertEqual(
+                new.decrypt_many(values), ['legacy', 'old', 'new', None])
+            self.assertEqual(
+                [new.from_db_value(value, None, None, None) for value in values],
+                ['legacy', 'old', 'new', None])
+            self.assertEqual(new.decrypt_many(values), old.decrypt_many(values))
+
+    def test_key_id_is_stored(self):
+        field = self._field(2, block_type='MODE_CBC')
+        self.assertTrue(field.get_db_prep_value('x').startswith(
+            '$AES$MODE_CBC$k2$'))
+        self.assertLessEqual(
+            len(field.get_db_prep_value('x' * 20)), field.max_length)
+        field = self._field(2, block_type='MODE_CBC', storage='binary')
+        self.assertEqual(bytearray(field.get_db_prep_value('x')[3:4])[0], 2)
+
+    def test_max_length_does_not_depend_on_keys(self):
+        self.fields.key_registry = keys.KeyRegistry()
+        field = EncryptedCharField(max_length=20, block_type='MODE_CBC')
+        self.assertEqual(
+            self._field(2, block_type='MODE_CBC').max_length, field.max_length)
+
+    def test_explicit_secret_key(self):
+        field = self._field(2, block_type='MODE_CBC', secret_key='k' * 32)
+        self.assertEqual(field.key_id, 0)
+        self.assertFalse(field.get_db_prep_value('x').startswith(
+            '$AES$MODE_CBC$k'))
+
+    def test_parallel_encryption_uses_active_key(self):
+        if parallel.futures is None:
+            return
+        field = self._field(2, block_type='MODE_CBC')
+        parallel._fields.clear()
+        with parallel.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            encrypted = parallel.encrypt_parallel(
+                field, ['one', 'two', 'three'], executor=executor, chunk_size=2)
+        parallel._fields.clear()
+        for value in encrypted:
+            self.assertTrue(value.startswith('$AES$MODE_CBC$k2$'))
+        self.assertEqual(field.decrypt_many(encrypted), ['one', 'two', 'three'])
+
+    def test_unknown_key(self):
+        encrypted = self._field(2, block_type='MODE_CBC').get_db_prep_value('x')
+        self.fields.key_registry = keys.KeyRegistry({1: 'first secret'})
+        field = EncryptedCharField(max_length=20, block_type='MODE_CBC')
+        self.assertRaises(
+            ValueError, field.from_db_value, encrypted, None, None, None)
+
+
+class RotationTests(unittest.TestCase):
+    def setUp(self):
+        from . import fields
+        self.fields = fields
+        self.original_registry = fields.key_registry
+        fields.key_registry = keys.KeyRegistry({1: 'old secret', 2: 'new secret'})
+        self._use_key(1)
+        RotationObject.objects.all().delete()
+        for index in range(25):
+            RotationObject.objects.create(
+                secret='secret %d' % index if index % 5 else None,
+                note='note %d' % index)
+        self._use_key(2)
+
+    def tearDown(self):
+        self._use_key(0)
+        self.fields.key_registry = self.original_registry
+
+    def _use_key(self, key_id):
+        for name in ('secret', 'note'):
+            RotationObject._meta.get_field(name)._use_key(key_id)
+
+    def _key_ids(self):
+        secret = RotationObject._meta.get_field('secret')
+        note = RotationObject._meta.get_field('note')
+        cursor = connection.cursor()
+        cursor.execute("select secret, note from django_fields_rotationobject")
+        return set(
+            (secret.key_id_of(raw_secret), note.key_id_of(raw_note))
+            for raw_secret, raw_note in cursor.fetchall())
+
+    def _check_values(self):
+        for index, obj in enumerate(RotationObject.objects.order_by('id')):
+            self.assertEqual(
+                obj.secret, 'secret %d' % index if index % 5 else None)
+            self.assertEqual(obj.note, 'note %d' % index)
+
+    def test_reencrypt(self):
+        self._check_values()
+        self.assertEqual(self._key_ids(), set([(1, 1), (None, 1)]))
+        progress = []
+        stats = rotation.reencrypt(
+            RotationObject, batch_size=7, progress=progress.append)
+        self.assertEqual(stats.rows, 25)
+        self.assertEqual(stats.values, 45)
+        self.assertEqual(stats.batches, 4)
+        self.assertEqual(len(progress), 4)
+        self.assertEqual(self._key_ids(), set([(2, 2), (None, 2)]))
+        self._check_values()
+        self.assertEqual(rotation.reencrypt(RotationObject).values, 0)
+
+    def test_resume_from_checkpoint(self):
+        import os
+        import tempfile
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'rotation.json')
+
+        def interrupt(stats):
+            raise KeyboardInterrupt
+
+        self.assertRaises(
+            KeyboardInterrupt, rotation.reencrypt, RotationObject,
+            fields=['note'], batch_size=10, checkpoint=checkpoint,
+            progress=interrupt)
+        self.assertTrue(os.path.exists(checkpoint))
+        stats = rotation.reencrypt(
+            RotationObject, fields=['note'], batch_size=10,
+            checkpoint=checkpoint)
+        self.assertEqual(stats.rows, 15)
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(self._key_ids(), set([(1, 2), (None, 2)]))
+        self._check_values()
+
+    def test_split_range(self):
+        queryset = RotationObject.objects.all()
+        ranges = rotation._split_range(queryset, 3)
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        for previous, following in zip(ranges, ranges[1:]):
+            self.assertEqual(previous[1], following[0])
+
+    def test_command(self):
+        from django.core.management import call_command
+        call_command('rotate_keys', 'django_fields.RotationObject',
+                     batch_size=10, rate_limit=10 ** 6, verbosity=0)
+        self.assertEqual(self._key_ids(), set([(2, 2), (None, 2)]))
+        self._check_values()
+
+
+class UpgradeEncryptionTests(unittest.TestCase):
+    def setUp(self):
+        RotationObject.objects.all().delete()
+        for index in range(10):
+            RotationObject.objects.create(
+                secret='secret %d' % index if index % 5 else None,
+                note='note %d' % index)
+        # Rewrite the secrets as written by the former ECB default.
+        legacy_field = EncryptedCharField(max_length=20)
+        cursor = connection.cursor()
+        for obj in RotationObject.objects.exclude(secret=None):
+            cursor.execute(
+                "update django_fields_rotationobject set secret = %s "
+                "where id = %s",
+                [legacy_field.get_db_prep_value(obj.secret), obj.pk])
+
+    def _stale(self):
+        field = RotationObject._meta.get_field('secret')
+        cursor = connection.cursor()
+        cursor.execute("select secret from django_fields_rotationobject")
+        return [raw for raw, in cursor.fetchall()
+                if raw is not None and field.needs_reencryption(raw)]
+
+    def _check_values(self):
+        for index, obj in enumerate(RotationObject.objects.order_by('id')):
+            self.assertEqual(
+                obj.secret, 'secret %d' % index if index % 5 else None)
+
+    def test_legacy_values_are_read_with_accept_legacy(self):
+        stale = self._stale()
+        self.assertEqual(len(stale), 8)
+        self.assertTrue(all(raw.startswith('$AES$') and '$MODE_' not in raw
+                            for raw in stale))
+        field = RotationObject._meta.get_field('secret')
+        self.assertRaises(
+            ValueError, field.from_db_value, stale[0], None, None, None)
+        legacy_field = EncryptedCharField(
+            max_length=20, block_type='MODE_CBC', accept_legacy=True)
+        self.assertEqual(
+            sorted(legacy_field.decrypt_many(stale)),
+            sorted('secret %d' % index for index in range(10) if index % 5))
+
+    def test_dry_run(self):
+        stats = rotation.reencrypt(RotationObject, batch_size=3, dry_run=True)
+        self.assertEqual(stats.rows, 10)
+        self.assertEqual(stats.values, 8)
+        self.assertIn('to re-encrypt', str(stats))
+        self.assertEqual(len(self._stale()), 8)
+
+    def test_command(self):
+        from django.core.management import call_command
+        call_command('upgrade_encryption', 'django_fields.RotationObject',
+                     batch_size=4, verbosity=0)
+        self.assertEqual(self._stale(), [])
+        self._check_values()
+        stats = rotation.reencrypt(RotationObject, dry_run=True)
+        self.assertEqual(stats.values, 0)